@@ -1,6 +1,26 @@
+import collections
+import itertools
+import logging
+import math
+import mmap
 import multiprocessing
+import os
+import re
+import select
+import signal
+import struct
+import time
 import unittest
 
+from operator import add, mul, neg, sub, truediv
+
+import metrics
+
+# numpy takes longer to import than the rest of the service, it is only loaded
+# the first time a batch is computed by VectorArithmeticOperator ( see load_numpy )
+numpy = None
+NUMPY_LOADED = False
+
 
 class ArithmeticOperatorValidationTest(unittest.TestCase):
     def validate(self, operation):
@@ -69,10 +89,232 @@ class ArithmeticOperatorOperationTest(unittest.TestCase):
         self.assertEqual(ArithmeticOperator.operate(" - 2 * 5 + 20 - 3 * 2"), 4.0)
 
 
+class FastArithmeticOperatorTest(unittest.TestCase):
+    EXPRESSIONS = ["3 + 4", "12 / 5 * 2 + 12 - 3 * 2", "-2 * 5 + 20 - 3 * 2", " - 2 * 5 + 20 - 3 * 2",
+                   "38 - 83 - 52 + 30 - 24 - 89 / 66 + 18 / 7 * 77", "3 + 4 * ? + 4 / 5", "+ 3 / 4 * 5",
+                   "zz 3 / 4 * 5", "3 / 4 * 5 +", "3/4*5-1"]
+
+    def test_same_results_as_arithmetic_operator(self):
+        for expression in FastArithmeticOperatorTest.EXPRESSIONS:
+            self.assertEqual(ArithmeticOperator.validate_and_operate(expression),
+                             FastArithmeticOperator.validate_and_operate(expression))
+
+    def test_operate_negative_factor(self):
+        self.assertEqual(FastArithmeticOperator.operate("3 * -2 + 1"), -5.0)
+
+    def test_operate_wrong_operator(self):
+        self.assertRaises(WrongOperatorFoundException, FastArithmeticOperator.operate, "3 4")
+
+
+class PlanArithmeticOperatorTest(unittest.TestCase):
+    def test_same_results_as_fast_operator(self):
+        for expression in FastArithmeticOperatorTest.EXPRESSIONS + ["3 * -2 + 1", "- - 4 / 2"]:
+            expected = FastArithmeticOperator.validate_and_operate(expression)
+            if isinstance(expected, float):
+                self.assertEqual(expected, PlanArithmeticOperator.validate_and_operate(expression))
+
+    def test_extended_grammar(self):
+        for expression, result in (("2 * (3 + 4)", 14.0), ("-(2 + 3) ^ 2", -25.0), ("-2 ^ 2", -4.0),
+                                   ("2 ^ 3 ^ 2", 512.0), ("2 ^ -1", 0.5), ("(1 + 2) * -(3 - 5)", 6.0),
+                                   ("1.5*(2)", 3.0), ("((7))", 7.0)):
+            self.assertEqual(result, PlanArithmeticOperator.operate(expression))
+
+    def test_not_valid(self):
+        self.assertEqual('unexpected end of expression at token 4',
+                         PlanArithmeticOperator.validate_operation_string("(1 + 2"))
+        self.assertEqual('unexpected ) at token 3', PlanArithmeticOperator.validate_operation_string("1 + 2)"))
+        self.assertEqual('unexpected number at token 1', PlanArithmeticOperator.validate_operation_string("3 4"))
+        self.assertEqual('wrong char, at position 2, not in 1234567890.+-*/^() ',
+                         PlanArithmeticOperator.validate_and_operate("3 ? 4"))
+        self.assertRaises(WrongOperatorFoundException, PlanArithmeticOperator.operate, "+ 3")
+        self.assertRaises(WrongOperatorFoundException, PlanArithmeticOperator.operate, "n + 3")
+        self.assertRaises(ZeroDivisionError, PlanArithmeticOperator.operate, "1 / (2 - 2)")
+
+    def test_plans_shared_by_template(self):
+        PlanArithmeticOperator.plans.clear()
+        for n in range(PlanArithmeticOperator.COMPILE_AFTER + 1):
+            self.assertEqual(2.0 * n + 1, PlanArithmeticOperator.operate("(%s + %s)*1 + (-1) ^ 2" % (n, n)))
+            self.assertEqual(['(0+0)*0+(-0)^0'], list(PlanArithmeticOperator.plans))
+        self.assertTrue(callable(PlanArithmeticOperator.plans['(0+0)*0+(-0)^0']))
+
+    def test_long_expressions(self):
+        expression = ' + '.join(['1'] * 2000)
+        for _ in range(PlanArithmeticOperator.COMPILE_AFTER + 1):
+            self.assertEqual(2000.0, PlanArithmeticOperator.operate(expression))
+        self.assertEqual(5.0, PlanArithmeticOperator.operate('(' * 2000 + '5' + ')' * 2000))
+
+
+class VectorArithmeticOperatorTest(unittest.TestCase):
+    def test_same_results_as_arithmetic_operator(self):
+        expressions = FastArithmeticOperatorTest.EXPRESSIONS + ["%s - %s * 3 / %s" % (n, n, n % 4) for n in range(40)]
+        expressions += ["%s - - %s * 3 + 1" % (n, n) for n in range(10)]
+        expected = []
+        for expression in expressions:
+            try:
+                expected.append(FastArithmeticOperator.validate_and_operate(expression))
+            except Exception as ex:
+                expected.append(str(ex))
+
+        response = [str(r) if isinstance(r, Exception) else r
+                    for r in VectorArithmeticOperator.operate_batch(expressions)]
+        self.assertEqual(expected, response)
+
+    def test_signature(self):
+        shape = VectorArithmeticOperator.shape("- 3 + 4 * -2 - 1")
+        self.assertEqual('-n+n*-n-n', shape)
+        self.assertEqual((('+', '*', '+'), [-1.0, 1.0, -1.0, -1.0]), VectorArithmeticOperator.signature(shape))
+
+    def test_signature_not_valid(self):
+        self.assertEqual(None, VectorArithmeticOperator.signature(VectorArithmeticOperator.shape("3 + 4 *")))
+
+
+class ResultCacheTest(unittest.TestCase):
+    def test_key(self):
+        self.assertEqual(ResultCache.key(" 3 +  4"), ResultCache.key("3 + 4 "))
+        self.assertNotEqual(ResultCache.key("3 4"), ResultCache.key("34"))
+
+    def test_lru_eviction(self):
+        cache = ResultCache(2)
+        cache.put_many([('a', 1.0), ('b', 2.0)])
+        cache.get_many(['a'])
+        cache.put_many([('c', 3.0)])
+        self.assertEqual([1.0, None, 3.0], cache.get_many(['a', 'b', 'c']))
+        self.assertEqual((3, 1), (cache.hits, cache.misses))
+
+    def test_cached_pool_evaluation(self):
+        calculator = ArithmecticPool(1, logging.getLogger('test'), cache_size=10)
+        first = calculator.evaluate_batch(0, 0, ["3 + 4", "1 / 0"])
+        second = calculator.evaluate_batch(0, 2, ["3 +  4", "1 / 0"])
+        self.assertEqual((1, 3), (calculator.cache.hits, calculator.cache.misses))
+        self.assertTrue(second[0].endswith('input_line[2]: 3 +  4 = 7.0 '))
+        self.assertEqual(first[1].replace('[1]', '[3]'), second[1])
+
+
+class KillingOperator:
+    """ kills the child computing a 'kill' line while `kills` is not 0, sleeps on 'hang' lines """
+    kills = None
+
+    @staticmethod
+    def validate_and_operate(operation_string):
+        if operation_string == 'kill':
+            with KillingOperator.kills.get_lock():
+                kill = KillingOperator.kills.value > 0
+                KillingOperator.kills.value -= kill
+            if kill:
+                os.kill(os.getpid(), signal.SIGKILL)
+        elif operation_string == 'hang':
+            time.sleep(60)
+        return FastArithmeticOperator.validate_and_operate(operation_string)
+
+
+class ArithmecticPoolSupervisionTest(unittest.TestCase):
+    OPERATIONS = ["%s + 1" % n for n in range(10)] + ["kill"] + ["%s * 2" % n for n in range(10)]
+
+    def results(self, kills, **options):
+        KillingOperator.kills = multiprocessing.Value('i', kills)
+        calculator = ArithmecticPool(2, logging.getLogger('test'), batch_size=2, operator=KillingOperator, **options)
+        return [r.split(' response, ')[1] for r in calculator.pool_processor(ArithmecticPoolSupervisionTest.OPERATIONS)]
+
+    def test_batch_of_a_dead_worker_sent_again(self):
+        for shared_memory in (False, True):
+            expected = [r.split(' response, ')[1] for r in ArithmecticPool(1, logging.getLogger('test'))
+                        .evaluate_batch(0, 0, ArithmecticPoolSupervisionTest.OPERATIONS)]
+            self.assertEqual(expected, self.results(2, batch_retries=2, shared_memory=shared_memory))
+            self.assertEqual(0, KillingOperator.kills.value)
+
+    def test_per_line_errors_after_the_retries(self):
+        for shared_memory in (False, True):
+            response = self.results(5, batch_retries=1, shared_memory=shared_memory)
+            self.assertEqual(21, len(response))
+            self.assertEqual(3, KillingOperator.kills.value)
+            self.assertEqual('input_line[10]: kill = worker died ', response[10])
+            self.assertEqual('input_line[11]: 0 * 2 = worker died ', response[11])
+            self.assertEqual('input_line[12]: 1 * 2 = 2.0 ', response[12])
+
+    def test_batch_timeout(self):
+        calculator = ArithmecticPool(2, logging.getLogger('test'), batch_size=1, operator=KillingOperator,
+                                     batch_timeout=0.5, batch_retries=0, response_format=RESPONSE_COMPACT)
+        start = time.time()
+        self.assertEqual(["0 7.0", "1 timed out after 0.5 s", "2 6.0"],
+                         calculator.pool_processor(["3 + 4", "hang", "2 * 3"]))
+        self.assertTrue(time.time() - start < 5)
+
+    def test_idle_child_dead_before_dispatch(self):
+        calculator = ArithmecticPool(1, logging.getLogger('test'), batch_size=1, response_format=RESPONSE_COMPACT)
+        spawn_child = calculator.spawn_child
+
+        def spawn_dead_child(i, table=None):
+            child = spawn_child(i, table)
+            if i == 0:
+                child[1].terminate()
+                child[1].join()
+            return child
+
+        calculator.spawn_child = spawn_dead_child
+        start = time.time()
+        self.assertEqual(["0 7.0"], calculator.pool_processor(["3 + 4"]))
+        self.assertTrue(time.time() - start < 5)
+
+
+class ArithmecticPoolTest(unittest.TestCase):
+    def pool_processor(self, operations, batch_size):
+        calculator = ArithmecticPool(2, logging.getLogger('test'), batch_size=batch_size)
+        return calculator.pool_processor(operations)
+
+    def test_batches(self):
+        calculator = ArithmecticPool(2, logging.getLogger('test'), batch_size=2)
+        self.assertEqual([(['1', '2'], 0), (['3'], 2)], list(calculator.batches(['1', '2', '3'])))
+
+    def test_tuned_batch_size(self):
+        calculator = ArithmecticPool(2, logging.getLogger('test'))
+        batch_size = calculator.tune_batch_size(["3 + 4 * 2"] * 10)
+        self.assertTrue(1 <= batch_size <= ArithmecticPool.MAX_BATCH_SIZE)
+
+    def test_pool_processor_batched(self):
+        response = self.pool_processor(["3 + 4", "2 * 3", "1 - 1"], batch_size=2)
+        self.assertEqual(3, len(response))
+        self.assertTrue(response[2].endswith('input_line[2]: 1 - 1 = 0.0 '))
+
+    def test_response_formats(self):
+        calculator = ArithmecticPool(1, logging.getLogger('test'))
+        self.assertEqual(["5 7.0", "6 wrong char, at position 2, not in 1234567890+-*/ "],
+                         calculator.evaluate_batch(0, 5, ["3 + 4", "3 ^ 2"], RESPONSE_COMPACT))
+        packed = calculator.evaluate_batch(0, 0, ["3 + 4", "1 / 0"], RESPONSE_BINARY)
+        self.assertEqual(7.0, PACKED_RESULT.unpack(packed[0])[0])
+        self.assertTrue(math.isnan(PACKED_RESULT.unpack(packed[1])[0]))
+
+    def test_shared_line_table(self):
+        table = SharedLineTable(["3 + 4", "", "10 * 2"])
+        self.assertEqual(["3 + 4", "", "10 * 2"], table.lines(0, 3))
+        self.assertEqual(["10 * 2"], table.lines(2, 3))
+
+    def test_pool_processor_shared_memory(self):
+        operations = ["%s + 1" % n for n in range(20)] + ["1 / 0", "3 ^ 2"]
+        calculator = ArithmecticPool(2, logging.getLogger('test'), batch_size=3, shared_memory=True)
+        self.assertEqual([r.split(' response, ')[1] for r in self.pool_processor(operations, batch_size=3)],
+                         [r.split(' response, ')[1] for r in calculator.pool_processor(operations)])
+
+    def test_pool_results_ordered(self):
+        calculator = ArithmecticPool(3, logging.getLogger('test'), batch_size=7, reorder_window=2)
+        operations = ["%s + 1" % n for n in range(100)]
+        response = [r for chunk in calculator.pool_results(operations) for r in chunk]
+        self.assertEqual(["input_line[%s]: %s + 1 = %s " % (n, n, n + 1.0) for n in range(100)],
+                         [r.split('response, ')[1] for r in response])
+
+    def test_inline_results(self):
+        calculator = ArithmecticPool(0, logging.getLogger('test'), response_format=RESPONSE_COMPACT)
+        self.assertEqual([["0 7.0", "1 6.0"]], list(calculator.inline_results(iter(["3 + 4", "2 * 3"]))))
+        self.assertEqual([], list(calculator.inline_results([])))
+
+
 class WrongOperatorFoundException(Exception):
     pass
 
 
+class WorkerFailedException(Exception):
+    pass
+
+
 class ArithmeticOperator:
     VALID = 'valid'
     VALID_CHARSET = '1234567890+-*/ '
@@ -151,92 +393,861 @@ class ArithmeticOperator:
             return validation_msg
 
 
+class FastArithmeticOperator:
+    """
+    validates and computes in a single scan of the tokens of the expression,
+    the regular expression splits them in one pass without intermediate strings.
+
+    it gives the same results and validation messages as ArithmeticOperator,
+    but a minus after '*' or '/' negates the next number instead of starting
+    a new term ( '3 * -2' is -6.0 ).
+    """
+    VALID = ArithmeticOperator.VALID
+    VALID_CHARSET = ArithmeticOperator.VALID_CHARSET
+    TOKENS = re.compile(r'\d+|[-+*/]|[^ ]')
+
+    @staticmethod
+    def validate_tokens(operation_string, tokens):
+        for token in tokens:
+            if not token.isdigit() and token not in '+-*/':
+                idx = operation_string.index(token)
+                if idx > 0:
+                    return 'wrong char, at position %s, not in %s' % (idx, FastArithmeticOperator.VALID_CHARSET)
+                break
+
+        if not tokens[-1].isdigit():
+            return 'last element is not valid'
+
+        if not tokens[0].isdigit() and tokens[0] != '-':
+            return 'first element is not valid'
+
+        return FastArithmeticOperator.VALID
+
+    @staticmethod
+    def validate_operation_string(operation_string):
+        tokens = FastArithmeticOperator.TOKENS.findall(operation_string)
+        return FastArithmeticOperator.validate_tokens(operation_string, tokens)
+
+    @staticmethod
+    def operate_tokens(tokens):
+        total, term, operator, negative = 0.0, None, '+', False
+        expect_number = True
+
+        for token in tokens:
+            if expect_number:
+                if token == '-':
+                    negative = not negative
+                    continue
+                if not token.isdigit():
+                    raise WrongOperatorFoundException(token)
+                value = float(token)
+                if negative:
+                    value, negative = -value, False
+
+                if operator == '*':
+                    term *= value
+                elif operator == '/':
+                    term /= value
+                else:
+                    # a new additive term starts, the previous one is done
+                    if term is not None:
+                        total += term
+                    term = value if operator == '+' else -value
+                expect_number = False
+            else:
+                if token not in '+-*/':
+                    raise WrongOperatorFoundException(token)
+                operator, expect_number = token, True
+
+        if expect_number:
+            raise WrongOperatorFoundException('expression ends with an operator')
+
+        return total + term
+
+    @staticmethod
+    def operate(operation_string):
+        return FastArithmeticOperator.operate_tokens(FastArithmeticOperator.TOKENS.findall(operation_string))
+
+    @staticmethod
+    def validate_and_operate(operation_string):
+        tokens = FastArithmeticOperator.TOKENS.findall(operation_string)
+        validation_msg = FastArithmeticOperator.validate_tokens(operation_string, tokens)
+
+        if validation_msg == FastArithmeticOperator.VALID:
+            return FastArithmeticOperator.operate_tokens(tokens)
+        else:
+            return validation_msg
+
+
+def load_numpy():
+    """ the numpy module, None when it is not installed """
+    global numpy, NUMPY_LOADED
+    if not NUMPY_LOADED:
+        NUMPY_LOADED = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+    return numpy
+
+
+class VectorArithmeticOperator(FastArithmeticOperator):
+    """
+    FastArithmeticOperator with a batch api: the expressions of a batch are
+    grouped by their shape ( the expression with its numbers replaced by 'n' ),
+    every group is validated once and computed with NumPy over the columns of
+    its operands. Small groups, divisions by zero and wrong expressions are
+    computed one by one, as they all are when NumPy is not installed.
+    """
+    MIN_GROUP_SIZE = 8
+    # translation tables: digits to 'n' for shapes, anything but digits to ' ' for operands
+    SHAPE_TABLE = ''.join('n' if chr(i).isdigit() else chr(i) for i in range(256))
+    OPERANDS_TABLE = ''.join(chr(i) if chr(i).isdigit() else ' ' for i in range(256))
+
+    @staticmethod
+    def shape(operation_string):
+        shape = operation_string.translate(VectorArithmeticOperator.SHAPE_TABLE).replace(' ', '')
+        while 'nn' in shape:
+            shape = shape.replace('nn', 'n')
+        return shape
+
+    @staticmethod
+    def signature(shape):
+        """
+        binary operators and sign of every operand of a valid flat expression
+        shape, None otherwise. subtractions become additions of the negated
+        operand, as FastArithmeticOperator.operate_tokens does.
+        """
+        if not shape or shape[-1] != 'n' or shape[0] not in 'n-':
+            return None
+
+        operators, signs, negative, expect_number = [], [], False, True
+        for char in shape:
+            if expect_number:
+                if char == '-':
+                    negative = not negative
+                elif char == 'n':
+                    signs.append(-1.0 if negative else 1.0)
+                    negative, expect_number = False, False
+                else:
+                    return None
+            else:
+                if char == '-':
+                    operators.append('+')
+                    negative = True
+                elif char in '+*/':
+                    operators.append(char)
+                else:
+                    return None
+                expect_number = True
+
+        return tuple(operators), signs
+
+    @staticmethod
+    def operate_group(operators, columns):
+        """ same operation order as operate_tokens so results are identical """
+        total, term = numpy.zeros(columns.shape[0]), columns[:, 0].copy()
+
+        for idx, operator in enumerate(operators):
+            column = columns[:, idx + 1]
+            if operator == '*':
+                term *= column
+            elif operator == '/':
+                term /= column
+            else:
+                total += term
+                term = column.copy()
+
+        return total + term
+
+    @staticmethod
+    def operate_one(operation_string, validate):
+        try:
+            if validate:
+                return FastArithmeticOperator.validate_and_operate(operation_string)
+            return FastArithmeticOperator.operate(operation_string)
+        except Exception as ex:
+            return ex
+
+    @staticmethod
+    def columns(operation_strings, signs):
+        numbers = ' '.join(operation_strings).translate(VectorArithmeticOperator.OPERANDS_TABLE)
+        columns = numpy.fromstring(numbers, sep=' ')
+        if columns.size != len(operation_strings) * len(signs):
+            return None
+
+        return columns.reshape(len(operation_strings), len(signs)) * signs
+
+    @staticmethod
+    def operate_batch(operation_strings, validate=True):
+        """
+        results of the batch in order, a validation message or the exception
+        raised take the place of the result of a wrong line.
+        """
+        results, groups = [None] * len(operation_strings), {}
+
+        for idx, operation_string in enumerate(operation_strings):
+            groups.setdefault(VectorArithmeticOperator.shape(operation_string), []).append(idx)
+
+        for shape, indexes in groups.items():
+            lines = [operation_strings[idx] for idx in indexes]
+            signature = VectorArithmeticOperator.signature(shape)
+            columns = None
+            if signature and len(indexes) >= VectorArithmeticOperator.MIN_GROUP_SIZE and load_numpy() is not None:
+                columns = VectorArithmeticOperator.columns(lines, signature[1])
+
+            if columns is None:
+                for idx, line in zip(indexes, lines):
+                    results[idx] = VectorArithmeticOperator.operate_one(line, validate)
+                continue
+
+            operators = signature[0]
+            with numpy.errstate(all='ignore'):
+                values = VectorArithmeticOperator.operate_group(operators, columns).tolist()
+
+            # scalar division by zero raises, numpy does not
+            divisors = [idx + 1 for idx, operator in enumerate(operators) if operator == '/']
+            if divisors:
+                for row in numpy.flatnonzero((columns[:, divisors] == 0).any(axis=1)):
+                    values[row] = VectorArithmeticOperator.operate_one(lines[row], validate)
+
+            for idx, value in zip(indexes, values):
+                results[idx] = value
+
+        return results
+
+
+class PlanArithmeticOperator:
+    """
+    extended grammar: parentheses, unary minus anywhere, decimal numbers and
+    powers ( ^ ). Powers bind tighter than the unary minus, which binds tighter
+    than products: -2 ^ 2 is -4.0 and 2 ^ 3 ^ 2 is 512.0.
+
+    Every expression is compiled to a postfix plan that only depends on its
+    template ( the expression without spaces and its numbers replaced by 0 ).
+    Plans are cached, so the expressions sharing a template with different
+    numbers are parsed once. The postfix plan runs on a stack until its template
+    has been seen COMPILE_AFTER times, then it is turned into a python function
+    of the numbers, which runs faster but takes longer to build.
+    """
+    VALID = ArithmeticOperator.VALID
+    VALID_CHARSET = '1234567890.+-*/^() '
+    NUMBERS = re.compile(r'(\d+(?:\.\d+)?)')
+    # binary operators: ( precedence, right associative, step of the plan )
+    BINARY = {'+': (1, False, add), '-': (1, False, sub), '*': (2, False, mul), '/': (2, False, truediv),
+              '^': (4, True, math.pow)}
+    NEG_PRECEDENCE = 3
+    PLAN_CACHE_SIZE = 100000
+    COMPILE_AFTER = 16
+    COMPILE_STEPS = 200
+    plans = {}
+
+    @staticmethod
+    def split(operation_string):
+        """ template and numbers of an expression in a single scan, digits in a template only stand for numbers """
+        parts = PlanArithmeticOperator.NUMBERS.split(operation_string)
+        return '0'.join(parts[::2]).replace(' ', ''), parts[1::2]
+
+    @staticmethod
+    def parse(template):
+        """
+        postfix plan of a template, a tuple of steps: None pushes the next number
+        of the expression, the other steps are unary ( neg ) or binary functions
+        of the top of the stack. Raises WrongOperatorFoundException if it is not valid.
+        """
+        plan, pending, expect_number = [], [], True
+        binary, neg_precedence = PlanArithmeticOperator.BINARY, PlanArithmeticOperator.NEG_PRECEDENCE
+
+        for position, token in enumerate(template):
+            if expect_number:
+                if token == '0':
+                    plan.append(None)
+                    expect_number = False
+                elif token == '-':
+                    pending.append((neg_precedence, neg))
+                elif token == '(':
+                    pending.append((0, None))
+                else:
+                    raise PlanArithmeticOperator.unexpected(token, position)
+            elif token in binary:
+                precedence, right, step = binary[token]
+                while pending and (pending[-1][0] > precedence or pending[-1][0] == precedence and not right):
+                    plan.append(pending.pop()[1])
+                pending.append((precedence, step))
+                expect_number = True
+            elif token == ')':
+                while pending and pending[-1][1] is not None:
+                    plan.append(pending.pop()[1])
+                if not pending:
+                    raise PlanArithmeticOperator.unexpected(token, position)
+                pending.pop()
+            else:
+                raise PlanArithmeticOperator.unexpected(token, position)
+
+        if expect_number or any(step is None for _, step in pending):
+            raise PlanArithmeticOperator.unexpected('', len(template))
+        plan.extend(step for _, step in reversed(pending))
+        return tuple(plan)
+
+    @staticmethod
+    def unexpected(token, position):
+        token = 'number' if token == '0' else token or 'end of expression'
+        return WrongOperatorFoundException('unexpected %s at token %s' % (token, position))
+
+    @staticmethod
+    def node(step, a, b=None):
+        """
+        function of the list of numbers computing `step` on the results of the
+        nodes a and b, a node given as an int is the index of a number
+        """
+        if step is neg:
+            return (lambda n: -n[a]) if isinstance(a, int) else (lambda n: -a(n))
+        if isinstance(a, int):
+            return (lambda n: step(n[a], n[b])) if isinstance(b, int) else (lambda n: step(n[a], b(n)))
+        return (lambda n: step(a(n), n[b])) if isinstance(b, int) else (lambda n: step(a(n), b(n)))
+
+    @staticmethod
+    def build(postfix):
+        """ function of the list of numbers of an expression computing its postfix plan, without eval """
+        stack, position = [], 0
+        for step in postfix:
+            if step is None:
+                stack.append(position)
+                position += 1
+            elif step is neg:
+                stack[-1] = PlanArithmeticOperator.node(neg, stack[-1])
+            else:
+                value = stack.pop()
+                stack[-1] = PlanArithmeticOperator.node(step, stack[-1], value)
+
+        return stack[0] if callable(stack[0]) else (lambda n: n[0])
+
+    @staticmethod
+    def execute(postfix, numbers):
+        stack, position = [], 0
+        for step in postfix:
+            if step is None:
+                stack.append(numbers[position])
+                position += 1
+            elif step is neg:
+                stack[-1] = -stack[-1]
+            else:
+                value = stack.pop()
+                stack[-1] = step(stack[-1], value)
+
+        return stack[0]
+
+    @staticmethod
+    def compile(operation_string, template):
+        """ cached plan of a template, the message of the first error as a string when it is not valid """
+        plans = PlanArithmeticOperator.plans
+        plan = plans.get(template)
+        if type(plan) is list:
+            plan[1] += 1
+            # the functions nest as deep as the plan, the longest ones stay on the stack
+            if plan[1] == PlanArithmeticOperator.COMPILE_AFTER and len(plan[0]) <= PlanArithmeticOperator.COMPILE_STEPS:
+                plan = plans[template] = PlanArithmeticOperator.build(plan[0])
+        if plan is not None:
+            return plan
+
+        for char in template:
+            if char not in '0.+-*/^()':
+                return 'wrong char, at position %s, not in %s' % (operation_string.index(char),
+                                                                  PlanArithmeticOperator.VALID_CHARSET)
+        try:
+            plan = [PlanArithmeticOperator.parse(template), 1]
+        except WrongOperatorFoundException as ex:
+            plan = str(ex)
+
+        if len(plans) >= PlanArithmeticOperator.PLAN_CACHE_SIZE:
+            plans.clear()
+        plans[template] = plan
+        return plan
+
+    @staticmethod
+    def validate_operation_string(operation_string):
+        plan = PlanArithmeticOperator.compile(operation_string, PlanArithmeticOperator.split(operation_string)[0])
+        return plan if isinstance(plan, str) else PlanArithmeticOperator.VALID
+
+    @staticmethod
+    def operate(operation_string):
+        result = PlanArithmeticOperator.validate_and_operate(operation_string)
+        if isinstance(result, str):
+            raise WrongOperatorFoundException(result)
+        return result
+
+    @staticmethod
+    def validate_and_operate(operation_string):
+        template, numbers = PlanArithmeticOperator.split(operation_string)
+        plan = PlanArithmeticOperator.compile(operation_string, template)
+        if isinstance(plan, str):
+            return plan
+
+        numbers = [float(number) for number in numbers]
+        if type(plan) is list:
+            return PlanArithmeticOperator.execute(plan[0], numbers)
+        return plan(numbers)
+
+
+OPERATORS = {
+    'classic': ArithmeticOperator,
+    'fast': FastArithmeticOperator,
+    'vector': VectorArithmeticOperator,
+    'plan': PlanArithmeticOperator,
+}
+
+
+class ResultCache:
+    """
+    bounded LRU cache of the results of the expressions, keyed by the expression
+    with its spaces collapsed. Only numeric results are stored, validation
+    messages depend on the positions of the characters.
+    """
+    SPACES = re.compile(' +')
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(operation_string):
+        return ResultCache.SPACES.sub(' ', operation_string).strip(' ')
+
+    def get_many(self, keys):
+        """ results of the keys, None for the ones not cached """
+        results = []
+        for key in keys:
+            result = self.entries.pop(key, None)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries[key] = result
+            results.append(result)
+
+        return results
+
+    def put_many(self, items):
+        for key, result in items:
+            self.entries.pop(key, None)
+            self.entries[key] = result
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return 'hits %s, misses %s, entries %s / %s' % (self.hits, self.misses, len(self.entries), self.size)
+
+
+# response formats negotiated by the clients: the full text of every operation, the
+# line number and its result, or the results packed as doubles ( nan for errors ).
+RESPONSE_VERBOSE, RESPONSE_COMPACT, RESPONSE_BINARY = 0, 1, 2
+RESPONSE_FORMATS = {'verbose': RESPONSE_VERBOSE, 'compact': RESPONSE_COMPACT, 'binary': RESPONSE_BINARY}
+PACKED_RESULT = struct.Struct('!d')
+
+
+class SharedLineTable:
+    """
+    lines of a request stored in an anonymous shared mmap and indexed by their
+    offsets, with a shared array of doubles for the results. Created before
+    the children are forked, so the pipes only carry index ranges.
+    """
+
+    def __init__(self, lines):
+        self.offsets = multiprocessing.RawArray('l', len(lines) + 1)
+        position = 0
+        for idx, line in enumerate(lines):
+            self.offsets[idx] = position
+            position += len(line)
+        self.offsets[len(lines)] = position
+
+        # unicode lines ( python 3 ) are stored one byte per character
+        data = ''.join(lines)
+        self.encoded = not isinstance(data, bytes)
+        self.buffer = mmap.mmap(-1, max(position, 1))
+        self.buffer.write(data.encode('latin-1') if self.encoded else data)
+        self.results = multiprocessing.RawArray('d', len(lines))
+
+    def lines(self, start, end):
+        offsets = self.offsets[start:end + 1]
+        data, base = self.buffer[offsets[0]:offsets[-1]], offsets[0]
+        if self.encoded:
+            data = data.decode('latin-1')
+        return [data[a - base:b - base] for a, b in zip(offsets, offsets[1:])]
+
+
 class ArithmecticPool:
     STOP_PILL = 'stop'
     TERMINATING_MSG = 'end'
 
-    def __init__(self, no_childs, log, validate_operations=True):
+    # batch size auto-tuning: lines timed in the parent and wanted time per batch
+    TUNING_SAMPLE = 100
+    BATCH_TARGET_SECONDS = 0.01
+    MAX_BATCH_SIZE = 5000
+
+    def __init__(self, no_childs, log, validate_operations=True, batch_size=0, reorder_window=0,
+                 operator=ArithmeticOperator, cache_size=0, shared_cache=None, shared_memory=False,
+                 response_format=RESPONSE_VERBOSE, batch_timeout=0, batch_retries=1):
         self.no_childs = no_childs
+        self.response_format = response_format
+        self.shared_memory = shared_memory
         self.log = log
+        self.operator = operator
+        self.cache = ResultCache(cache_size) if cache_size else None
+        self.shared_cache = shared_cache
         self.validate_operations = validate_operations
+        self.batch_size = batch_size
+        self.reorder_window = reorder_window or max(no_childs * 4, 1)
+        self.batch_timeout = batch_timeout
+        self.batch_retries = batch_retries
+        self.no_messages_sent = 0
+        self.next_child = no_childs
 
-    def job(self, i, conn):
+    def job(self, i, conn, table=None):
         while True:
-            (msg, n) = conn.recv()
-            # self.log.debug("process %s %s  - msgno %s" % (i, msg, n))
+            (batch, n) = conn.recv()
+            # self.log.debug("process %s %s  - msgno %s" % (i, batch, n))
 
-            if msg == ArithmecticPool.STOP_PILL:
+            if batch == ArithmecticPool.STOP_PILL:
+                metrics.flush()
                 conn.send(ArithmecticPool.TERMINATING_MSG)
                 self.log.debug("end sent %s" % i)
+                if self.cache:
+                    self.log.info('process[%s] cache: %s' % (i, self.cache.stats()))
+                break
+            elif table is not None:
+                with metrics.timer('compute'):
+                    response = self.evaluate_shared(i, table, *batch)
+                metrics.count('lines computed', batch[1] - batch[0])
+                conn.send(response)
+            else:
+                with metrics.timer('compute'):
+                    return_msgs = self.evaluate_batch(i, n, batch)
+                metrics.count('lines computed', len(batch))
+                conn.send(return_msgs)
+                self.log.debug('process[%s] batch of %s lines from input_line[%s] done' % (i, len(batch), n))
+
+    @staticmethod
+    def format_result(i, n, msg, result):
+        if isinstance(result, Exception):
+            return "error[%s] response, input_line[%s]: %s = %s " % (i, n, msg, result)
+
+        return "process[%s] response, input_line[%s]: %s = %s " % (i, n, msg, result)
+
+    def format_results(self, i, n, batch, results, response_format=None):
+        if response_format is None:
+            response_format = self.response_format
+
+        if response_format == RESPONSE_BINARY:
+            return [PACKED_RESULT.pack(result if isinstance(result, float) else float('nan')) for result in results]
+        if response_format == RESPONSE_COMPACT:
+            return ["%s %s" % (n + offset, result) for offset, result in enumerate(results)]
+
+        return [self.format_result(i, n + offset, msg, result)
+                for offset, (msg, result) in enumerate(zip(batch, results))]
+
+    def compute(self, msg):
+        try:
+            if self.validate_operations:
+                return self.operator.validate_and_operate(msg)
+            else:
+                return self.operator.operate(msg)
+        except Exception as ex:
+            return ex
+
+    def compute_batch(self, batch):
+        if hasattr(self.operator, 'operate_batch'):
+            return self.operator.operate_batch(batch, self.validate_operations)
+
+        return [self.compute(msg) for msg in batch]
+
+    def cached_compute_batch(self, batch):
+        """ looks up the local cache, then the shared one, and computes the rest """
+        keys = [ResultCache.key(msg) for msg in batch]
+        results = self.cache.get_many(keys) if self.cache else [None] * len(batch)
+
+        missing = [idx for idx, result in enumerate(results) if result is None]
+        if missing and self.shared_cache is not None:
+            shared = self.shared_cache.get_many([keys[idx] for idx in missing])
+            found = [(idx, result) for idx, result in zip(missing, shared) if result is not None]
+            for idx, result in found:
+                results[idx] = result
+            if self.cache and found:
+                self.cache.put_many((keys[idx], result) for idx, result in found)
+            missing = [idx for idx, result in zip(missing, shared) if result is None]
+
+        computed = self.compute_batch([batch[idx] for idx in missing])
+        new_items = []
+        for idx, result in zip(missing, computed):
+            results[idx] = result
+            if isinstance(result, float):
+                new_items.append((keys[idx], result))
+
+        if new_items:
+            if self.cache:
+                self.cache.put_many(new_items)
+            if self.shared_cache is not None:
+                self.shared_cache.put_many(new_items)
+
+        return results
+
+    def evaluate(self, i, n, msg):
+        return self.format_result(i, n, msg, self.compute(msg))
+
+    def batch_results(self, batch):
+        if self.cache or self.shared_cache is not None:
+            return self.cached_compute_batch(batch)
+
+        return self.compute_batch(batch)
+
+    def evaluate_batch(self, i, n, batch, response_format=None):
+        return self.format_results(i, n, batch, self.batch_results(batch), response_format)
+
+    def evaluate_shared(self, i, table, start, end):
+        """ values go to the shared results, errors and validation messages travel back with the range """
+        errors = []
+        for offset, result in enumerate(self.batch_results(table.lines(start, end))):
+            if isinstance(result, float):
+                table.results[start + offset] = result
+            else:
+                errors.append((offset, result))
+
+        return i, start, end, errors
+
+    def format_shared(self, operations_data, table, response):
+        (i, start, end, errors) = response
+        results = table.results[start:end]
+        for offset, error in errors:
+            results[offset] = error
+
+        return self.format_results(i, start, operations_data[start:end], results)
+
+    def tune_batch_size(self, sample):
+        """
+        batch size needed so a child spends about BATCH_TARGET_SECONDS on each
+        batch, measured evaluating a sample of the lines in the parent.
+        """
+        if not sample:
+            return 1
+
+        start = time.time()
+        self.compute_batch(sample)
+        line_cost = (time.time() - start) / len(sample)
+
+        if not line_cost:
+            return ArithmecticPool.MAX_BATCH_SIZE
+
+        batch_size = int(ArithmecticPool.BATCH_TARGET_SECONDS / line_cost)
+        return max(1, min(batch_size, ArithmecticPool.MAX_BATCH_SIZE))
+
+    def batches(self, operations_data):
+        operations_data = iter(operations_data)
+        batch_size = self.batch_size
+
+        if not batch_size:
+            sample = list(itertools.islice(operations_data, ArithmecticPool.TUNING_SAMPLE))
+            batch_size = self.tune_batch_size(sample)
+            operations_data = itertools.chain(sample, operations_data)
+            self.log.debug(' * batch size tuned to %s lines' % batch_size)
+
+        n = 0
+        while True:
+            batch = list(itertools.islice(operations_data, batch_size))
+            if not batch:
                 break
+            yield batch, n
+            n += len(batch)
+
+    def shared_batches(self, operations_data):
+        """ index ranges of the batches, for children reading the lines from a SharedLineTable """
+        for batch, n in self.batches(operations_data):
+            yield (n, n + len(batch)), n
+
+    def failed_batch(self, i, batch, n, error):
+        return self.format_results(i, n, batch, [error] * len(batch))
+
+    @staticmethod
+    def failed_range(i, batch, n, error):
+        (start, end) = batch
+        return i, start, end, [(offset, error) for offset in range(end - start)]
+
+    def spawn_child(self, i, table=None):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=self.job, args=(i, child_conn, table))
+        p.daemon = True
+        p.start()
+        # the pipe gets to EOF when the child dies
+        child_conn.close()
+        return i, p, parent_conn
+
+    def replace_child(self, process_list, conn, spawn):
+        """ terminates the child owning `conn` and puts a new one in its place, returns the id of the old one """
+        position = [c for _, _, c in process_list].index(conn)
+        i, p, _ = process_list[position]
+        if p.is_alive():
+            p.terminate()
+        p.join()
+        conn.close()
+
+        process_list[position] = spawn(self.next_child)
+        self.next_child += 1
+        return i
+
+    def collect(self, process_list, batches, spawn, failed):
+        """
+        keeps every child busy with one batch at a time and blocks on all the
+        child connections at once until some of them answer.
+
+        yields the results of contiguous batches in input order, at most
+        `reorder_window` batches are dispatched ahead of the oldest one pending.
+
+        A child that dies, or spends more than `batch_timeout` seconds on a batch,
+        is replaced by a new one from `spawn` and its batch is sent again, up to
+        `batch_retries` times. Then `failed` gives an error for each of its lines.
+        """
+        busy, done, retry = {}, {}, collections.deque()
+        next_batch = to_yield = 0
+        batches = iter(batches)
+        exhausted = False
+
+        while True:
+            failures = {}
+            for _, _, conn in process_list:
+                if conn in busy:
+                    continue
+                if retry:
+                    task = retry.popleft()
+                elif exhausted or next_batch - to_yield >= self.reorder_window:
+                    break
+                else:
+                    try:
+                        batch, n = next(batches)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    task = (next_batch, batch, n, 0)
+                    next_batch += 1
+                    self.no_messages_sent += len(batch)
+
+                busy[conn] = task + (time.time(),)
+                try:
+                    with metrics.timer('dispatch'):
+                        conn.send(task[1:3])
+                except (IOError, OSError):
+                    failures[conn] = 'worker died'
+
+            if not busy:
+                break
+
+            timeout = None
+            if failures:
+                # every busy child may have failed already, nothing to wait for
+                timeout = 0
+            elif self.batch_timeout:
+                oldest = min(task[4] for task in busy.values())
+                timeout = max(0, oldest + self.batch_timeout - time.time())
+
+            with metrics.timer('collect'):
+                ready, _, _ = select.select([conn for conn in busy if conn not in failures], [], [], timeout)
+                for conn in ready:
+                    try:
+                        response = conn.recv()
+                    except (EOFError, IOError, OSError):
+                        failures[conn] = 'worker died'
+                        continue
+                    done[busy.pop(conn)[0]] = response
+
+            if self.batch_timeout:
+                now = time.time()
+                for conn, task in busy.items():
+                    if conn not in failures and now - task[4] >= self.batch_timeout:
+                        failures[conn] = 'timed out after %s s' % self.batch_timeout
+
+            for conn, reason in failures.items():
+                (index, batch, n, attempts, _) = busy.pop(conn)
+                i = self.replace_child(process_list, conn, spawn)
+                metrics.count('worker failures')
+                if attempts < self.batch_retries:
+                    self.log.warning('process[%s] %s, batch from input_line[%s] sent again' % (i, reason, n))
+                    retry.append((index, batch, n, attempts + 1))
+                else:
+                    self.log.error('process[%s] %s, batch from input_line[%s] failed' % (i, reason, n))
+                    done[index] = failed(i, batch, n, WorkerFailedException(reason))
+
+            while to_yield in done:
+                yield done.pop(to_yield)
+                to_yield += 1
+
+    def stop_child(self, p, conn):
+        """ waits for the end message of a child sent the stop pill, one not answering in time is terminated """
+        try:
+            while True:
+                if self.batch_timeout and not conn.poll(self.batch_timeout):
+                    p.terminate()
+                    break
+                # a batch abandoned by the consumer may still be answered before the end
+                if conn.recv() == ArithmecticPool.TERMINATING_MSG:
+                    break
+        except (EOFError, IOError, OSError):
+            # the child is already gone
+            pass
+        p.join()
+
+    def pool_results(self, operations_data):
+        """
+        generator of ordered chunks of results, children live while it runs.
+        With `shared_memory` a list of lines is handed to the children in a
+        SharedLineTable, streams of lines are always sent through the pipes.
+        """
+        self.no_messages_sent = 0
+        self.next_child = self.no_childs
+
+        table = None
+        if self.shared_memory and isinstance(operations_data, list):
+            table = SharedLineTable(operations_data)
+            self.log.debug(' * %s lines in shared memory' % len(operations_data))
+
+        def spawn(i):
+            return self.spawn_child(i, table)
+
+        process_list = [spawn(i) for i in range(self.no_childs)]
+
+        try:
+            if table is None:
+                for chunk in self.collect(process_list, self.batches(operations_data), spawn, self.failed_batch):
+                    yield chunk
             else:
+                responses = self.collect(process_list, self.shared_batches(operations_data), spawn, self.failed_range)
+                for response in responses:
+                    yield self.format_shared(operations_data, table, response)
+        finally:
+            for _, p, conn in process_list:
                 try:
-                    if self.validate_operations:
-                        result = ArithmeticOperator.validate_and_operate(msg)
-                    else:
-                        result = ArithmeticOperator.operate(msg)
-
-                    return_msg = "process[%s] response, input_line[%s]: %s = %s " % (i, n, msg, result)
-                    conn.send(return_msg)
-                    self.log.debug(return_msg)
-
-                except Exception as ex:
-                    error_msg = "error[%s] response, input_line[%s]: %s = %s " % (i, n, msg, ex)
-                    conn.send(error_msg)
-                    self.log.debug(return_msg)
-
-    def listener_loop(self, ps, q_out):
-
-        while self.no_childs:
-            for p in ps:
-                if p[1].poll():
-                    msg_in = p[1].recv()
-                    self.log.debug(msg_in)
-                    if msg_in.strip() == ArithmecticPool.TERMINATING_MSG:
-                        self.no_childs -= 1
-                        self.log.debug('process %s stopping , left running:%s' % (p[0], self.no_childs))
-                    else:
-                        q_out.put(msg_in)
+                    conn.send((ArithmecticPool.STOP_PILL, 0))
+                except (IOError, OSError):
+                    pass
+                self.log.debug('  -> stopping ... %s' % p)
 
-    def pool_processor(self, operations_data):
-        process_list, output_queue = [], multiprocessing.Queue()
-
-        for i in range(self.no_childs):
-            parent_conn, child_conn = multiprocessing.Pipe()
-            p = multiprocessing.Process(target=self.job, args=(i, child_conn,))
-            p.daemon = True
-            process_list.append((p, parent_conn))
-
-        listener = multiprocessing.Process(target=self.listener_loop,
-                                           args=(process_list, output_queue,))
-        listener.daemon = True
-        listener.start()
-
-        for process_tuple in process_list:
-            process_tuple[0].start()
-
-        idx = no_messages_sent = 0
-
-        for msg in operations_data:
-            idx = idx if idx != self.no_childs else 0
-            process_list[idx][1].send((msg, no_messages_sent))
-            no_messages_sent += 1
-            """
-            self.log.debug(
-                'sending ... to process:%s total_msg_sent:%s / %s' % (idx, no_messages_sent, records_to_process))
-            """
-            idx += 1
-
-        for process_tuple in process_list:
-            process_tuple[1].send((ArithmecticPool.STOP_PILL, 0))
-            self.log.debug('  -> stopping ... %s' % process_tuple[0])
+            for _, p, conn in process_list:
+                self.stop_child(p, conn)
+                self.log.debug('process %s stopped' % p)
 
-        results = []
+    def inline_results(self, operations_data):
+        """ results of a request too small to pay for forking children, computed in one batch here """
+        batch = list(operations_data)
+        if batch:
+            with metrics.timer('compute'):
+                results = self.evaluate_batch(0, 0, batch)
+            metrics.count('lines computed', len(batch))
+            yield results
 
-        while len(results) != no_messages_sent:
-            element = output_queue.get()
-            results.append(element)
+    def pool_processor(self, operations_data):
+        results = []
+        for chunk in self.pool_results(operations_data):
+            results.extend(chunk)
 
-        self.log.info(' * work done: operations returned %s - operations sent %s' % (len(results), no_messages_sent))
+        self.log.info(' * work done: operations returned %s - operations sent %s' %
+                      (len(results), self.no_messages_sent))
 
         return results
@@ -0,0 +1,562 @@
+import Queue
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from algebra import ArithmecticPool, FastArithmeticOperator, OPERATORS, RESPONSE_FORMATS
+from common import get_log, descompress_7zip_file, send_request, LineStream, SevenZipStream, SocketReader
+from common import RESPONSE_ZLIB
+
+"""
+python benchmark.py pool --input-file operations.7z --childs 4 --repeat 3
+python benchmark.py operator --input-file operations.7z --repeat 3
+python benchmark.py decompress --input-file operations.7z
+python benchmark.py service --concurrency 8 --requests 10 --lines 20000 --service_args="--persistent_pool"
+python benchmark.py service --input-file operations.7z --save baseline.json
+python benchmark.py startup --repeat 10
+python benchmark.py service --input-file operations.7z --baseline baseline.json --service_args="--event_loop"
+"""
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_measure(self):
+        result, wall, cpu = measure(sum, range(1000))
+        self.assertEqual(499500, result)
+        self.assertTrue(wall >= 0 and cpu >= 0)
+
+    def test_benchmark_pool_processor(self):
+        stats = benchmark_pool_processor(["3 + 4"] * 10, 2, 0, 1, logging.getLogger('test'))
+        self.assertEqual(1, len(stats))
+
+    def test_peak_memory(self):
+        result, peak = peak_memory(len, 'abc')
+        self.assertEqual(3, result)
+        self.assertTrue(peak >= 0)
+
+    def test_benchmark_decompression(self):
+        stats = benchmark_decompression('operations.7z', logging.getLogger('test'))
+        self.assertEqual(stats['whole'][0], stats['streamed'][0])
+
+    def test_benchmark_operators(self):
+        stats = benchmark_operators(["3 + 4 * 2"] * 10, 1, logging.getLogger('test'))
+        self.assertEqual(sorted(OPERATORS), sorted(stats))
+
+    def test_load_client_reports_errors(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        results = Queue.Queue()
+        load_client('127.0.0.1', port, ['3 + 4'], 0, results)
+        self.assertTrue(isinstance(results.get_nowait(), str))
+        self.assertEqual(None, results.get_nowait())
+
+    def test_generate_operations(self):
+        lines = generate_operations(50, '+*', 3, seed=1).split('\n')
+        self.assertEqual(50, len(lines))
+        self.assertEqual(lines, generate_operations(50, '+*', 3, seed=1).split('\n'))
+        self.assertTrue(all(2 <= len(line.split()) // 2 + 1 <= 3 for line in lines))
+        self.assertTrue(all(isinstance(r, float) for r in map(FastArithmeticOperator.validate_and_operate, lines)))
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual((50, 95, 99, 100), tuple(percentile(values, p) for p in (50, 95, 99, 100)))
+        self.assertEqual(7, percentile([7], 99))
+        self.assertEqual(0, percentile([], 50))
+
+    def test_process_tree(self):
+        p = multiprocessing.Process(target=time.sleep, args=(1,))
+        p.start()
+        try:
+            self.assertEqual([os.getpid(), p.pid], process_tree(os.getpid()))
+            self.assertTrue(tree_rss(os.getpid()) > 0 and tree_cpu(os.getpid()) > 0)
+        finally:
+            p.terminate()
+            p.join()
+
+
+def cpu_time():
+    """ cpu seconds spent by this process and by its finished children """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def measure(func, *args):
+    start_wall, start_cpu = time.time(), cpu_time()
+    result = func(*args)
+    return result, time.time() - start_wall, cpu_time() - start_cpu
+
+
+def peak_memory(func, *args):
+    """ result of func run in a new child and how much its peak resident memory grew, in kb """
+    queue = multiprocessing.Queue()
+
+    def run():
+        start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = func(*args)
+        queue.put((result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start))
+
+    p = multiprocessing.Process(target=run)
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def count_lines_whole(path):
+    data = descompress_7zip_file(path)[0]
+    return len([i for i in data.split('\n') if i.strip()])
+
+
+def count_lines_streamed(path):
+    with open(path, 'rb') as file7z:
+        return sum(1 for _ in LineStream(SevenZipStream(file7z)))
+
+
+def benchmark_decompression(path, log):
+    """ lines, wall time and peak memory growth decompressing a 7z archive whole and streamed """
+    stats = {}
+    for name, func in (('whole', count_lines_whole), ('streamed', count_lines_streamed)):
+        start = time.time()
+        lines, peak = peak_memory(func, path)
+        stats[name] = (lines, time.time() - start, peak)
+        log.info('%s decompression: %s lines in %.3f s, peak memory +%s kb' % ((name,) + stats[name]))
+
+    return stats
+
+
+def load_lines(path):
+    if path.endswith('.7z'):
+        data = descompress_7zip_file(path)[0]
+    else:
+        with open(path, 'r') as input_fd:
+            data = input_fd.read()
+
+    return [i for i in data.split('\n') if i.strip()]
+
+
+def benchmark_pool_processor(lines, no_childs, batch_size, repeat, log, shared_memory=False):
+    stats = []
+    for n in range(repeat):
+        calculator = ArithmecticPool(no_childs, log, batch_size=batch_size, shared_memory=shared_memory)
+        response, wall, cpu = measure(calculator.pool_processor, lines)
+        log.info('pool run %s: %s lines in %.3f s wall, %.3f s cpu' % (n, len(response), wall, cpu))
+        stats.append((wall, cpu))
+
+    return stats
+
+
+def run_operator(operator, lines, batch_size=2000):
+    if hasattr(operator, 'operate_batch'):
+        return [operator.operate_batch(lines[i:i + batch_size]) for i in range(0, len(lines), batch_size)]
+
+    return [operator.validate_and_operate(line) for line in lines]
+
+
+def benchmark_operators(lines, repeat, log):
+    """ every operator implementation on the same lines, in batches when it has a batch api """
+    stats = {}
+    for name, operator in sorted(OPERATORS.items()):
+        stats[name] = []
+        for n in range(repeat):
+            _, wall, cpu = measure(run_operator, operator, lines)
+            log.info('%s operator run %s: %.0f lines/s' % (name, n, len(lines) / wall if wall else 0))
+            stats[name].append((wall, cpu))
+
+    return stats
+
+
+def generate_operations(no_lines, operators='+-*/', max_terms=10, seed=None):
+    """ synthetic input, one expression per line of 2 to `max_terms` operands between 1 and 100 """
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(no_lines):
+        tokens = [str(rng.randint(1, 100))]
+        for _ in range(rng.randint(2, max_terms) - 1):
+            tokens.extend((rng.choice(operators), str(rng.randint(1, 100))))
+        lines.append(' '.join(tokens))
+
+    return '\n'.join(lines)
+
+
+def percentile(values, p):
+    """ nearest rank percentile, 0 without values """
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    return ordered[max(0, int(round(p / 100.0 * len(ordered))) - 1)]
+
+
+def proc_stat(pid):
+    """ fields of /proc/<pid>/stat after the command name, the state is the first one """
+    with open('/proc/%s/stat' % pid) as stat_file:
+        data = stat_file.read()
+    return data[data.rindex(')') + 2:].split()
+
+
+def process_tree(pid):
+    """ pid and the pids of all its descendants, parents first """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            children.setdefault(int(proc_stat(entry)[1]), []).append(int(entry))
+        except (IOError, OSError):
+            # gone while listing
+            continue
+
+    tree = [pid]
+    for parent in tree:
+        tree.extend(sorted(children.get(parent, [])))
+    return tree
+
+
+def tree_cpu(pid):
+    """
+    cpu seconds of a process tree: user and system time of every process alive
+    plus the time of the children they have already reaped.
+    """
+    ticks = 0
+    for member in process_tree(pid):
+        try:
+            ticks += sum(int(field) for field in proc_stat(member)[11:15])
+        except (IOError, OSError):
+            continue
+
+    return float(ticks) / os.sysconf('SC_CLK_TCK')
+
+
+def tree_rss(pid):
+    """ resident memory of a process tree, in kb """
+    rss = 0
+    for member in process_tree(pid):
+        try:
+            with open('/proc/%s/status' % member) as status_file:
+                for line in status_file:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1])
+        except (IOError, OSError):
+            continue
+
+    return rss
+
+
+def start_service(host, port, service_args, log, timeout=10):
+    """ service.py in a new process, once it accepts connections """
+    command = [sys.executable, 'service.py', '--host', host, '--port', str(port)] + service_args
+    with open(os.devnull, 'w') as devnull:
+        service = subprocess.Popen(command, stdout=devnull, stderr=devnull)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if service.poll() is not None:
+            raise RuntimeError('service exited with code %s' % service.returncode)
+        try:
+            socket.create_connection((host, port)).close()
+            log.info('service started: %s' % ' '.join(command))
+            return service
+        except socket.error:
+            time.sleep(0.01)
+
+    stop_service(service)
+    raise RuntimeError('service not listening on %s:%s after %s s' % (host, port, timeout))
+
+
+def stop_service(service):
+    """ interrupts the service as ctrl-c does, its remaining descendants are killed """
+    members = process_tree(service.pid)
+    service.send_signal(signal.SIGINT)
+    deadline = time.time() + 5
+    while service.poll() is None and time.time() < deadline:
+        time.sleep(0.1)
+
+    for pid in reversed(members):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            continue
+    service.wait()
+
+
+def load_client(host, port, payloads, flags, results):
+    """
+    sends each payload on a new connection, puts its latency and response size
+    on `results`. An error ends the client and is put as a message, None is put
+    at the end in any case.
+    """
+    try:
+        for data in payloads:
+            start = time.time()
+            sock = socket.create_connection((host, port))
+            send_request(sock, data, True, flags)
+            size = sum(len(chunk) for chunk in SocketReader(sock, 65536).recv_chunks(True))
+            sock.close()
+            results.put((time.time() - start, size))
+    except Exception as e:
+        results.put('client %s failed: %r' % (os.getpid(), e))
+    finally:
+        results.put(None)
+
+
+def benchmark_service(host, port, service_pid, payloads, no_lines, concurrency, flags, log, sample_interval=0.05):
+    """
+    every client process sends its list of `payloads` one request after the
+    other. The memory of the service is sampled while they run, its cpu time
+    is read at the start and at the end.
+    """
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=load_client, args=(host, port, client_payloads, flags, results))
+               for client_payloads in payloads]
+
+    start_cpu, peak_rss = tree_cpu(service_pid), tree_rss(service_pid)
+    start = time.time()
+    for p in clients:
+        p.start()
+
+    latencies, errors, response_bytes, finished = [], [], 0, 0
+    while finished < concurrency:
+        peak_rss = max(peak_rss, tree_rss(service_pid))
+        try:
+            result = results.get(timeout=sample_interval)
+        except Queue.Empty:
+            continue
+
+        if result is None:
+            finished += 1
+        elif isinstance(result, str):
+            log.warning(result)
+            errors.append(result)
+        else:
+            latencies.append(result[0])
+            response_bytes += result[1]
+
+    wall = time.time() - start
+    cpu = tree_cpu(service_pid) - start_cpu
+    for p in clients:
+        p.join()
+
+    requests = len(latencies)
+    stats = {'requests': requests, 'errors': len(errors), 'lines': no_lines * requests,
+             'response_bytes': response_bytes, 'wall': wall,
+             'requests_per_second': requests / wall, 'lines_per_second': no_lines * requests / wall,
+             'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99),
+             'peak_rss_kb': peak_rss, 'cpu_per_request': cpu / requests if requests else 0}
+    log.info('%(requests)s requests, %(lines)s lines in %(wall).3f s: %(requests_per_second).2f requests/s, '
+             '%(lines_per_second).0f lines/s, %(errors)s failed clients' % stats)
+    log.info('latency p50 %(p50).3f s, p95 %(p95).3f s, p99 %(p99).3f s' % stats)
+    log.info('service peak rss %(peak_rss_kb)s kb, %(cpu_per_request).3f s cpu per request, '
+             '%(response_bytes)s response bytes' % stats)
+
+    return stats
+
+
+def run_command(command):
+    """ wall time of a command run to its end """
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(command, stdout=devnull, stderr=devnull)
+    return time.time() - start
+
+
+def benchmark_startup(host, port, repeat, log):
+    """
+    wall time of importing the service and the client modules, of a service
+    until it accepts connections and of a client sending a small request.
+    """
+    directory = tempfile.mkdtemp()
+    input_path, output_path = os.path.join(directory, 'input.txt'), os.path.join(directory, 'output.txt')
+    with open(input_path, 'w') as input_fd:
+        input_fd.write(generate_operations(10, seed=0))
+
+    client = [sys.executable, 'client.py', '--host', host, '--port', str(port), '--input-file', input_path,
+              '--output-file', output_path]
+    stats = dict((name, []) for name in ('import service', 'import client', 'service start', 'client run'))
+    try:
+        for _ in range(repeat):
+            for module in ('service', 'client'):
+                stats['import %s' % module].append(run_command([sys.executable, '-c', 'import %s' % module]))
+
+            start = time.time()
+            service = start_service(host, port, [], log)
+            stats['service start'].append(time.time() - start)
+            try:
+                stats['client run'].append(run_command(client))
+            finally:
+                stop_service(service)
+    finally:
+        shutil.rmtree(directory)
+
+    for name in ('import service', 'import client', 'service start', 'client run'):
+        log.info('%s: best %.3f s, mean %.3f s' % (name, min(stats[name]), sum(stats[name]) / len(stats[name])))
+    return stats
+
+
+def compare_to_baseline(stats, baseline, log):
+    for name in ('requests_per_second', 'lines_per_second', 'p50', 'p95', 'p99', 'peak_rss_kb', 'cpu_per_request'):
+        if baseline.get(name):
+            log.info('%s: %.3f, baseline %.3f ( %+.1f%% )' %
+                     (name, stats[name], baseline[name], (stats[name] - baseline[name]) * 100.0 / baseline[name]))
+
+
+def report(name, stats, log):
+    walls, cpus = [s[0] for s in stats], [s[1] for s in stats]
+    log.info('%s: best %.3f s wall, mean %.3f s wall, mean %.3f s cpu per request' %
+             (name, min(walls), sum(walls) / len(walls), sum(cpus) / len(cpus)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Blueliv-Benchmark')
+
+    parser.add_argument("--verbose",
+                        help="increase output verbosity",
+                        action="store_true")
+    subparsers = parser.add_subparsers(dest="command")
+
+    pool_parser = subparsers.add_parser("pool", help="cpu and wall time of ArithmecticPool.pool_processor")
+    pool_parser.add_argument("--input-file",
+                             dest="in_file",
+                             help="path of the input file, txt or 7z format",
+                             default="operations.7z")
+    pool_parser.add_argument("--childs",
+                             type=int,
+                             help="number of arithmetic children",
+                             default=4)
+    pool_parser.add_argument("--batch_size",
+                             type=int,
+                             help="lines per batch, 0 means auto-tuned",
+                             default=0)
+    pool_parser.add_argument("--repeat",
+                             type=int,
+                             default=3)
+    pool_parser.add_argument("--shared_memory",
+                             help="hand the lines to the children in shared memory",
+                             action="store_true")
+
+    operator_parser = subparsers.add_parser("operator", help="lines per second of each arithmetic operator")
+    operator_parser.add_argument("--input-file",
+                                 dest="in_file",
+                                 help="path of the input file, txt or 7z format",
+                                 default="operations.7z")
+    operator_parser.add_argument("--repeat",
+                                 type=int,
+                                 default=3)
+
+    decompress_parser = subparsers.add_parser("decompress",
+                                              help="time and peak memory of whole and streamed 7z decompression")
+    decompress_parser.add_argument("--input-file",
+                                   dest="in_file",
+                                   help="path of the 7z input file",
+                                   default="operations.7z")
+
+    service_parser = subparsers.add_parser("service",
+                                           help="throughput, latency, memory and cpu of service.py under load")
+    service_parser.add_argument("--input-file",
+                                dest="in_file",
+                                help="file sent as is by every request, synthetic expressions when missing")
+    service_parser.add_argument("--lines",
+                                type=int,
+                                help="lines of each synthetic request",
+                                default=10000)
+    service_parser.add_argument("--operators",
+                                help="operators of the synthetic expressions",
+                                default="+-*/")
+    service_parser.add_argument("--max_terms",
+                                type=int,
+                                help="maximun operands of a synthetic expression",
+                                default=10)
+    service_parser.add_argument("--concurrency",
+                                type=int,
+                                help="clients sending requests at the same time",
+                                default=4)
+    service_parser.add_argument("--requests",
+                                type=int,
+                                help="requests sent by each client",
+                                default=5)
+    service_parser.add_argument("--response_format",
+                                choices=sorted(RESPONSE_FORMATS),
+                                default="verbose")
+    service_parser.add_argument("--compress",
+                                help="ask for zlib compressed responses",
+                                action="store_true")
+    service_parser.add_argument("--host",
+                                default="127.0.0.1")
+    service_parser.add_argument("--port",
+                                type=int,
+                                default=12399)
+    service_parser.add_argument("--service_args",
+                                help="options of service.py after an equal sign: --service_args=\"--event_loop\"",
+                                default="")
+    service_parser.add_argument("--save",
+                                help="write the results to this json file")
+    service_parser.add_argument("--baseline",
+                                help="json file of a previous run to compare with")
+
+    startup_parser = subparsers.add_parser("startup", help="cold start of the service and one shot client runs")
+    startup_parser.add_argument("--host",
+                                default="127.0.0.1")
+    startup_parser.add_argument("--port",
+                                type=int,
+                                default=12399)
+    startup_parser.add_argument("--repeat",
+                                type=int,
+                                default=5)
+
+    args = parser.parse_args()
+    log = get_log('Blueliv-Benchmark', args.verbose)
+
+    if args.command == 'pool':
+        lines = load_lines(args.in_file)
+        stats = benchmark_pool_processor(lines, args.childs, args.batch_size, args.repeat, log, args.shared_memory)
+        report('pool_processor', stats, log)
+    elif args.command == 'operator':
+        lines = load_lines(args.in_file)
+        for name, stats in sorted(benchmark_operators(lines, args.repeat, log).items()):
+            report(name, stats, log)
+    elif args.command == 'decompress':
+        benchmark_decompression(args.in_file, log)
+    elif args.command == 'service':
+        if args.in_file:
+            with open(args.in_file, 'rb') as input_fd:
+                data = input_fd.read()
+            no_lines = len(load_lines(args.in_file))
+            payloads = [[data] * args.requests for _ in range(args.concurrency)]
+        else:
+            no_lines = args.lines
+            payloads = [[generate_operations(args.lines, args.operators, args.max_terms, seed=(n, i))
+                         for i in range(args.requests)] for n in range(args.concurrency)]
+
+        flags = RESPONSE_FORMATS[args.response_format] | (RESPONSE_ZLIB if args.compress else 0)
+        service = start_service(args.host, args.port, shlex.split(args.service_args), log)
+        try:
+            stats = benchmark_service(args.host, args.port, service.pid, payloads, no_lines, args.concurrency,
+                                      flags, log)
+        finally:
+            stop_service(service)
+
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                compare_to_baseline(stats, json.load(baseline_file), log)
+        if args.save:
+            with open(args.save, 'w') as save_file:
+                json.dump(stats, save_file, indent=2, sort_keys=True)
+    elif args.command == 'startup':
+        benchmark_startup(args.host, args.port, args.repeat, log)
+
+
+if __name__ == '__main__':
+    main()
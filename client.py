@@ -1,19 +1,74 @@
 import argparse
+import collections
+import errno
+import glob
+import logging
+import os
+import select
+import shutil
 import socket
+import tempfile
+import time
+import unittest
 
-from common import get_log, wait, END_SEQUENCE
+from algebra import RESPONSE_FORMATS
+from common import get_log, wait, send_request, ConnectionClosedException, ResponseDecoder, ResponseParser
+from common import SocketReader, FRAME_MAGIC, REQUEST_HEADER, RESPONSE_ZLIB
 
 """
 client.py [-h] [--verbose] --port PORT --host HOST --output-file
                  OUT_FILE --input-file IN_FILE
 
 python client.py --verbose --port 12345 --host 127.0.0.1 --output-file out --input-file operations.7z
+python client.py --port 12345 --host 127.0.0.1 --output-file outdir --input-file 'inputs/*.7z' --connections 4
 """
 
 
+class PipelinedClientTest(unittest.TestCase):
+    def setUp(self):
+        # the service side is only needed by the tests, the client runs without it
+        from eventloop import EventLoopService
+        from workers import ArithmeticWorkerPool
+
+        log = logging.getLogger('test')
+        pool = ArithmeticWorkerPool(log, min_workers=1, max_workers=2, jobs_per_worker=1000, no_slots=2,
+                                    scale_up_depth=10, batch_size=2)
+        self.service = EventLoopService(log, '127.0.0.1', 0, 5, 1024, pool)
+        self.service.start()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.service.stop()
+        shutil.rmtree(self.directory)
+
+    def test_files_pipelined(self):
+        for n in range(5):
+            with open(os.path.join(self.directory, '%s.txt' % n), 'w') as input_fd:
+                input_fd.write("%s + 1\n%s * 2" % (n, n))
+
+        output_dir = os.path.join(self.directory, 'out')
+        client = PipelinedClient('127.0.0.1', self.service.port, logging.getLogger('test'),
+                                 input_files(os.path.join(self.directory, '*.txt')), output_dir, 1024,
+                                 no_connections=2, depth=2)
+        client.start()
+        deadline = time.time() + 10
+        while not client.done() and time.time() < deadline:
+            self.service.poll_once(0.01)
+            client.step(0.01)
+        client.close()
+
+        for n in range(5):
+            with open(os.path.join(output_dir, '%s.txt.out' % n)) as output_fd:
+                lines = output_fd.read().split('\n')
+            self.assertTrue(lines[1].endswith('input_line[1]: %s * 2 = %s ' % (n, n * 2.0)))
+
+
 class Client:
-    def __init__(self, ip_address, port, log, output_file, input_file, block_size):
+    def __init__(self, ip_address, port, log, output_file, input_file, block_size, framed=True, flags=0):
         self.log = log
+        self.framed = framed
+        # response options are only negotiated by framed requests
+        self.flags = flags if framed else 0
         self.ip_address = ip_address
         self.port = port
         self.block_size = block_size
@@ -42,28 +97,22 @@ class Client:
 
         if data:
             self.log.info('sending data ...')
-            # self.socket.send(data + END_SEQUENCE)
-            self.socket.send(data)
-            self.socket.send(END_SEQUENCE)
+            send_request(self.socket, data, self.framed, self.flags)
             self.log.info('data sent')
 
     def get_response(self):
         self.log.info('reading socket ...')
-        no_chunks = 1
-        response = self.socket.recv(self.block_size)
-        self.log.debug(' ... chunck read ... %s' % no_chunks)
+        reader = SocketReader(self.socket, self.block_size)
+        decoder = ResponseDecoder(self.flags)
 
-        while response[-len(END_SEQUENCE):] != END_SEQUENCE:
-            no_chunks += 1
-            response += self.socket.recv(self.block_size)
-            self.log.debug(' ... chunck read ... %s' % no_chunks)
+        with open(self.output_filename, "wb") as output_fd:
+            for no_chunks, chunk in enumerate(reader.recv_chunks(self.framed)):
+                output_fd.write(decoder.decode(chunk))
+                self.log.debug(' ... chunck read ... %s' % (no_chunks + 1))
+            output_fd.write(decoder.flush())
 
-        response = response[:-len(END_SEQUENCE)]
         self.log.info(' *** end of reading ***')
 
-        with open(self.output_filename, "wb") as output_fd:
-            output_fd.write(response)
-
     def close_client(self):
         self.socket.close()
 
@@ -76,6 +125,150 @@ class Client:
         self.log.info('finished')
 
 
+class PipelinedConnection:
+    """ framed connection with several requests in flight, sends and reads never block """
+
+    def __init__(self, sock, block_size, flags):
+        self.socket = sock
+        self.socket.setblocking(0)
+        self.block_size = block_size
+        self.flags = flags
+        self.output = collections.deque()
+        self.parser = ResponseParser()
+        self.in_flight = collections.deque()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def queue(self, input_filename, output_filename):
+        with open(input_filename, "rb") as input_fd:
+            data = input_fd.read()
+
+        self.output.append(REQUEST_HEADER.pack(FRAME_MAGIC, self.flags, len(data)))
+        self.output.append(data)
+        self.in_flight.append((input_filename, open(output_filename, "wb"), ResponseDecoder(self.flags)))
+
+    def write(self):
+        while self.output:
+            data = self.output[0]
+            try:
+                sent = self.socket.send(data)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            if sent < len(data):
+                self.output[0] = data[sent:]
+                return
+            self.output.popleft()
+
+    def read(self):
+        """ writes the chunks received, returns the input files whose response has ended """
+        try:
+            data = self.socket.recv(self.block_size)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise
+
+        if not data:
+            raise ConnectionClosedException('%s responses missing' % len(self.in_flight))
+
+        finished = []
+        for chunk in self.parser.feed(data):
+            input_filename, output_fd, decoder = self.in_flight[0]
+            if chunk is not None:
+                output_fd.write(decoder.decode(chunk))
+                continue
+
+            output_fd.write(decoder.flush())
+            output_fd.close()
+            self.in_flight.popleft()
+            finished.append(input_filename)
+
+        return finished
+
+
+class PipelinedClient:
+    """
+    sends many files over a few persistent framed connections, each one with
+    up to `depth` requests in flight. The response of every input file is
+    saved in the output directory, named after it.
+    """
+
+    def __init__(self, ip_address, port, log, input_files, output_dir, block_size, no_connections=4, depth=8,
+                 flags=0):
+        self.log = log
+        self.ip_address = ip_address
+        self.port = port
+        self.block_size = block_size
+        self.pending = collections.deque(input_files)
+        self.output_dir = output_dir
+        self.no_connections = no_connections
+        self.depth = depth
+        self.flags = flags
+        self.connections = []
+        self.no_done = 0
+
+    def output_filename(self, input_filename):
+        return os.path.join(self.output_dir, os.path.basename(input_filename) + '.out')
+
+    def start(self):
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        for _ in range(min(self.no_connections, len(self.pending))):
+            sock = socket.create_connection((self.ip_address, self.port))
+            self.connections.append(PipelinedConnection(sock, self.block_size, self.flags))
+        self.log.info('%s connections to %s:%s' % (len(self.connections), self.ip_address, self.port))
+
+    def done(self):
+        return not self.pending and not any(connection.in_flight for connection in self.connections)
+
+    def step(self, timeout=None):
+        # files are handed out in turns so the connections stay balanced
+        queued = True
+        while self.pending and queued:
+            queued = False
+            for connection in self.connections:
+                if self.pending and len(connection.in_flight) < self.depth:
+                    input_filename = self.pending.popleft()
+                    connection.queue(input_filename, self.output_filename(input_filename))
+                    queued = True
+
+        readers = [connection for connection in self.connections if connection.in_flight]
+        writers = [connection for connection in self.connections if connection.output]
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+
+        for connection in writable:
+            connection.write()
+        for connection in readable:
+            for input_filename in connection.read():
+                self.no_done += 1
+                self.log.info('%s done ( %s )' % (input_filename, self.no_done))
+
+    def close(self):
+        for connection in self.connections:
+            connection.socket.close()
+
+    def run(self):
+        self.log.info('running ...')
+        self.start()
+        while not self.done():
+            self.step()
+        self.close()
+        self.log.info('finished: %s files' % self.no_done)
+
+
+def input_files(path):
+    """ files of a directory or matching a glob pattern """
+    if os.path.isdir(path):
+        path = os.path.join(path, '*')
+
+    return sorted(name for name in glob.glob(path) if os.path.isfile(name))
+
+
 def main():
     parser = argparse.ArgumentParser(description='Blueliv-Client')
 
@@ -91,22 +284,48 @@ def main():
                         required=True)
     parser.add_argument("--output-file",
                         dest="out_file",
-                        help="path where results will be saved",
+                        help="path where results will be saved, a directory for several input files",
                         required=True)
     parser.add_argument("--input-file",
                         dest="in_file",
-                        help="path of the input file, txt or 7z format",
+                        help="path of the input file, txt, 7z, gzip or bz2 format, or a directory or glob of them",
                         required=True)
     parser.add_argument("--block_size",
                         dest="block_size",
                         help="socket data size transmission",
                         type=int,
                         default=4096)
+    parser.add_argument("--sentinel",
+                        help="use the end sequence protocol of older services instead of framed messages",
+                        action="store_true")
+    parser.add_argument("--response_format",
+                        choices=sorted(RESPONSE_FORMATS),
+                        help="verbose lines, line number and result, or results packed as doubles",
+                        default="verbose")
+    parser.add_argument("--compress",
+                        help="ask for a zlib compressed response",
+                        action="store_true")
+    parser.add_argument("--connections",
+                        type=int,
+                        help="connections kept open when sending several files",
+                        default=4)
+    parser.add_argument("--pipeline_depth",
+                        type=int,
+                        help="requests sent ahead on each connection when sending several files",
+                        default=8)
 
     args = parser.parse_args()
 
     log = get_log('Blueliv-Client', args.verbose)
-    client = Client(args.host, args.port, log, args.out_file, args.in_file, args.block_size)
+    flags = RESPONSE_FORMATS[args.response_format] | (RESPONSE_ZLIB if args.compress else 0)
+    if os.path.isdir(args.in_file) or glob.has_magic(args.in_file):
+        if args.sentinel:
+            parser.error("several files are only sent with framed messages")
+        client = PipelinedClient(args.host, args.port, log, input_files(args.in_file), args.out_file,
+                                 args.block_size, args.connections, args.pipeline_depth, flags)
+    else:
+        client = Client(args.host, args.port, log, args.out_file, args.in_file, args.block_size, not args.sentinel,
+                        flags)
     client.run()
 
 
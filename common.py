@@ -1,9 +1,15 @@
 import StringIO
+import errno
+import itertools
 import logging
+import socket
+import struct
+import tempfile
 import time
 import unittest
+import zlib
 
-import py7zlib
+from algebra import PACKED_RESULT, RESPONSE_BINARY, RESPONSE_COMPACT
 
 wait = time.sleep
 END_SEQUENCE = ('En_un_lugar_de_la_Mancha,_de_cuyo_nombre_no_quiero_acordarme'
@@ -11,6 +17,19 @@ END_SEQUENCE = ('En_un_lugar_de_la_Mancha,_de_cuyo_nombre_no_quiero_acordarme'
                 '_de_los_de_lanza_en_astillero_adarga_antigua'
                 '_rocin_flaco_y_galgo_corredor')
 
+SEVENZIP_MAGIC = '7z\xbc\xaf\x27\x1c'
+
+# framed protocol: a request is MAGIC + flags + body length + body, the response
+# is a sequence of length prefixed chunks ended by an empty one.
+FRAME_MAGIC = 'ASF1'
+REQUEST_HEADER = struct.Struct('!4sBQ')
+CHUNK_HEADER = struct.Struct('!I')
+
+# flags of a framed request: response format ( see algebra.RESPONSE_FORMATS ) and
+# zlib compression of the response body. Sentinel requests get verbose text.
+RESPONSE_FORMAT_MASK = 0x03
+RESPONSE_ZLIB = 0x04
+
 
 class Test7zip(unittest.TestCase):
     def test_descompress_7zip_file(self):
@@ -21,12 +40,19 @@ class Test7zip(unittest.TestCase):
         self.assertEqual(content_txt, file_content)
 
     def test_descompress_string_format_error(self):
+        import py7zlib
         resp = StringIO.StringIO('supercalifrastico')
         try:
             descompress_7zip_stream(resp)
         except py7zlib.FormatError:
             self.assertTrue(True)
 
+    def test_7zip_stream_in_chunks(self):
+        with open('operations.7z', 'rb') as file7z:
+            chunks = list(SevenZipStream(file7z, block_size=4096))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(descompress_7zip_file('operations.7z')[0], ''.join(chunks))
+
     def test_descompress_7zip_stream(self):
         with open('operations.7z', 'rb') as file7z:
             stream = file7z.read()
@@ -35,6 +61,629 @@ class Test7zip(unittest.TestCase):
         self.assertTrue(isinstance(response, str))
 
 
+class ConnectionLogTest(unittest.TestCase):
+    def test_address_before_the_message(self):
+        log = ConnectionLog(logging.getLogger('test'), ('127.0.0.1', 4000))
+        self.assertEqual(('conn [ 127.0.0.1:4000 ]: * working ...', {}), log.process(' * working ...', {}))
+
+
+class FramedProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def test_framed_request(self):
+        send_request(self.client, '3 + 4\n2 * 3', framed=True)
+        self.assertEqual(('3 + 4\n2 * 3', 0), SocketReader(self.server, 4).recv_request())
+
+    def test_sentinel_request_split_across_reads(self):
+        send_request(self.client, '3 + 4\n2 * 3', framed=False)
+        self.assertEqual(('3 + 4\n2 * 3', None), SocketReader(self.server, 7).recv_request())
+
+    def test_idle_connection_closed(self):
+        reader = SocketReader(self.server, 4)
+        self.assertTrue(reader.closed(0.1))
+        send_request(self.client, '3 + 4', framed=True)
+        self.assertFalse(reader.closed(0.1))
+        self.assertEqual(('3 + 4', 0), reader.recv_request())
+
+    def test_framed_response(self):
+        writer = ResponseWriter(self.server, framed=True)
+        writer.write('a')
+        writer.write('bc')
+        writer.close()
+        self.assertEqual(['a', 'bc'], list(SocketReader(self.client, 2).recv_chunks(framed=True)))
+
+    def test_sentinel_response(self):
+        writer = ResponseWriter(self.server, framed=False)
+        writer.write('abc')
+        writer.close()
+        self.assertEqual('abc', ''.join(SocketReader(self.client, 3).recv_chunks(framed=False)))
+
+    def test_sentinel_body_streamed(self):
+        send_request(self.client, '3 + 4\n2 * 3', framed=False)
+        reader = SocketReader(self.server, 5)
+        flags, length, prefix = reader.recv_header()
+        self.assertEqual((None, None), (flags, length))
+        self.assertEqual(['3 + 4', '2 * 3'], list(LineStream(reader.iter_body(length, prefix))))
+
+    def test_framed_body_streamed(self):
+        send_request(self.client, '3 + 4\n\n2 * 3\n', framed=True)
+        reader = SocketReader(self.server, 3)
+        flags, length, prefix = reader.recv_header()
+        lines = LineStream(reader.iter_body(length, prefix))
+        self.assertEqual(['3 + 4', '2 * 3'], list(lines))
+        self.assertTrue(lines.exhausted)
+
+    def test_peek(self):
+        head, chunks = peek(iter(['ab', 'cd', 'ef']), 3)
+        self.assertEqual('abc', head)
+        self.assertEqual('abcdef', ''.join(chunks))
+
+    def test_request_parser_framed(self):
+        parser, request = RequestParser(), REQUEST_HEADER.pack(FRAME_MAGIC, 0, 5) + '3 + 4'
+        self.assertEqual([False] * (len(request) - 1) + [True], [parser.feed(c) for c in request])
+        self.assertEqual(('3 + 4', True), (parser.data(), parser.framed))
+
+    def test_request_parser_sentinel(self):
+        parser = RequestParser()
+        self.assertFalse(parser.feed('3 + 4' + END_SEQUENCE[:10]))
+        self.assertTrue(parser.feed(END_SEQUENCE[10:]))
+        self.assertEqual(('3 + 4', False), (parser.data(), parser.framed))
+
+    def test_request_parser_pipelined(self):
+        parser = RequestParser()
+        requests = REQUEST_HEADER.pack(FRAME_MAGIC, 0, 5) + '3 + 4' + REQUEST_HEADER.pack(FRAME_MAGIC, 1, 0)
+        self.assertTrue(parser.feed(requests))
+        self.assertEqual('3 + 4', parser.data())
+        parser, rest = RequestParser(), parser.rest
+        self.assertTrue(parser.feed(rest))
+        self.assertEqual(('', 1), (parser.data(), parser.flags))
+
+    def test_response_parser(self):
+        writer, parser = ResponseWriter(self.server, framed=True), ResponseParser()
+        writer.write('abc')
+        writer.close()
+        writer.write('d')
+        data = self.client.recv(1024)
+        self.assertEqual([], parser.feed(data[:5]))
+        self.assertEqual(['abc', None], parser.feed(data[5:-2]))
+        self.assertEqual(['d'], parser.feed(data[-2:]))
+
+    def test_spilled_response(self):
+        held = SpilledResponse(4, block_size=4)
+        for data in ['abc', 'def', 'g']:
+            held.append(data)
+        self.assertEqual((6, ['g']), (held.spilled, held.held))
+        writer = ResponseWriter(self.server, framed=True)
+        held.drain(writer)
+        held.append('h')
+        held.drain(writer)
+        writer.close()
+        self.assertEqual(['abcd', 'ef', 'g', 'h'], list(SocketReader(self.client, 2).recv_chunks(framed=True)))
+        self.assertEqual((None, 0), (held.file, held.size))
+
+    def test_spilled_response_sent_without_blocking(self):
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        held = SpilledResponse(4096, block_size=4096)
+        writer = ResponseWriter(self.server, framed=True)
+        data = ['%05d' % n for n in range(100000)]
+        for block in data:
+            held.append(block)
+            # the client does not read yet, what the socket does not take stays held
+            held.send_ready(writer)
+        self.assertTrue(held.spilled)
+
+        # the client reads at last, the rest is sent as the socket takes it
+        self.client.setblocking(0)
+        parser, received = ResponseParser(), []
+        while sum(len(chunk) for chunk in received) < len(''.join(data)):
+            held.send_ready(writer)
+            try:
+                received.extend(parser.feed(self.client.recv(65536)))
+            except socket.error:
+                pass
+        self.assertTrue(held.send_ready(writer))
+        self.assertEqual(''.join(data), ''.join(received))
+
+    def test_compressed_compact_response(self):
+        flags = RESPONSE_COMPACT | RESPONSE_ZLIB
+        encoder, decoder = ResponseEncoder(flags), ResponseDecoder(flags)
+        body = encoder.encode(["0 7.0", "1 6.0"]) + encoder.encode(["2 -1.0"]) + encoder.flush()
+        self.assertEqual("0 7.0\n1 6.0\n2 -1.0", decoder.decode(body[:5]) + decoder.decode(body[5:]) + decoder.flush())
+
+    def test_binary_response(self):
+        encoder, decoder = ResponseEncoder(RESPONSE_BINARY), ResponseDecoder(RESPONSE_BINARY)
+        body = encoder.encode([PACKED_RESULT.pack(7.0), PACKED_RESULT.pack(float('nan'))]) + encoder.flush()
+        self.assertEqual(16, len(body))
+        self.assertEqual("7.0\nnan", decoder.decode(body[:3]) + decoder.decode(body[3:]) + decoder.flush())
+
+    def test_request_too_large(self):
+        send_request(self.client, 'x' * 100, framed=True)
+        self.assertRaises(RequestTooLargeException, SocketReader(self.server, 4, max_request_size=10).recv_header)
+        header = REQUEST_HEADER.pack(FRAME_MAGIC, 0, 2 ** 62)
+        self.assertRaises(RequestTooLargeException, RequestParser(10).feed, header)
+        parser = RequestParser(10)
+        self.assertFalse(parser.feed('3 + 4\n'))
+        self.assertRaises(RequestTooLargeException, parser.feed, '2 * 3\n' * 30)
+
+    def test_connection_closed(self):
+        self.client.sendall(FRAME_MAGIC)
+        self.client.close()
+        self.assertRaises(ConnectionClosedException, SocketReader(self.server, 4).recv_request)
+
+
+class ConnectionClosedException(Exception):
+    pass
+
+
+class RequestTooLargeException(Exception):
+    pass
+
+
+def check_request_size(size, max_request_size):
+    """ a body larger than `max_request_size` bytes ( 0 for no limit ) is rejected before being read """
+    if max_request_size and size > max_request_size:
+        raise RequestTooLargeException('request of %s bytes or more, the maximum is %s' % (size, max_request_size))
+
+
+class SocketReader:
+    """
+    reads requests and responses in linear time, framed bodies are received
+    straight into a single preallocated buffer. Request bodies are limited to
+    `max_request_size` bytes, 0 for no limit.
+    """
+
+    def __init__(self, sock, block_size, max_request_size=0):
+        self.socket = sock
+        self.block_size = block_size
+        self.max_request_size = max_request_size
+
+    def recv_exactly(self, size):
+        data = bytearray(size)
+        view, received = memoryview(data), 0
+
+        while received < size:
+            n = self.socket.recv_into(view[received:], min(size - received, self.block_size))
+            if not n:
+                raise ConnectionClosedException('%s bytes missing' % (size - received))
+            received += n
+
+        return data
+
+    def recv_until_sentinel(self, data=''):
+        """ only the new chunk and the tail of the previous one are checked """
+        chunks, tail, size = [data], data[-len(END_SEQUENCE):], len(data)
+
+        while not tail.endswith(END_SEQUENCE):
+            chunk = self.socket.recv(self.block_size)
+            if not chunk:
+                raise ConnectionClosedException('end sequence not found')
+            chunks.append(chunk)
+            tail = (tail + chunk)[-len(END_SEQUENCE):]
+            size += len(chunk)
+            check_request_size(size - len(END_SEQUENCE), self.max_request_size)
+
+        return ''.join(chunks)[:-len(END_SEQUENCE)]
+
+    def iter_until_sentinel(self, data=''):
+        """ yields chunks as they arrive, holding back what could be the end sequence """
+        pending, size = data, len(data)
+
+        while not pending.endswith(END_SEQUENCE):
+            chunk = self.socket.recv(self.block_size)
+            if not chunk:
+                raise ConnectionClosedException('end sequence not found')
+            pending += chunk
+            size += len(chunk)
+            check_request_size(size - len(END_SEQUENCE), self.max_request_size)
+            if len(pending) > len(END_SEQUENCE):
+                yield pending[:-len(END_SEQUENCE)]
+                pending = pending[-len(END_SEQUENCE):]
+
+        if pending[:-len(END_SEQUENCE)]:
+            yield pending[:-len(END_SEQUENCE)]
+
+    def iter_exactly(self, size):
+        while size:
+            chunk = self.socket.recv(min(size, self.block_size))
+            if not chunk:
+                raise ConnectionClosedException('%s bytes missing' % size)
+            size -= len(chunk)
+            yield chunk
+
+    def recv_header(self):
+        """
+        returns the flags and the body length of the request, both None when the
+        peer speaks the sentinel protocol, plus the body bytes already read.
+        """
+        prefix = str(self.recv_exactly(len(FRAME_MAGIC)))
+        if prefix != FRAME_MAGIC:
+            return None, None, prefix
+
+        header = prefix + str(self.recv_exactly(REQUEST_HEADER.size - len(FRAME_MAGIC)))
+        _, flags, length = REQUEST_HEADER.unpack(header)
+        check_request_size(length, self.max_request_size)
+        return flags, length, ''
+
+    def iter_body(self, length, data=''):
+        """ body of the request in chunks, as they are received """
+        if data:
+            yield data
+
+        if length is None:
+            for chunk in self.iter_until_sentinel():
+                yield chunk
+        else:
+            for chunk in self.iter_exactly(length - len(data)):
+                yield chunk
+
+    def closed(self, idle_timeout=0):
+        """
+        waits for the next request, True when the peer closes the connection
+        instead or sends nothing for `idle_timeout` seconds ( 0 waits forever ).
+        """
+        self.socket.settimeout(idle_timeout or None)
+        try:
+            return not self.socket.recv(1, socket.MSG_PEEK)
+        except socket.timeout:
+            return True
+        finally:
+            self.socket.settimeout(None)
+
+    def recv_request(self):
+        """
+        returns the body and the flags of the request, flags are None when the
+        peer speaks the sentinel protocol.
+        """
+        flags, length, prefix = self.recv_header()
+        if length is None:
+            return self.recv_until_sentinel(prefix), None
+
+        return str(self.recv_exactly(length)), flags
+
+    def recv_chunks(self, framed):
+        if not framed:
+            yield self.recv_until_sentinel()
+            return
+
+        while True:
+            (length,) = CHUNK_HEADER.unpack(str(self.recv_exactly(CHUNK_HEADER.size)))
+            if not length:
+                break
+            yield str(self.recv_exactly(length))
+
+
+class LineStream:
+    """
+    non blank lines of a stream of chunks, yielded while the chunks are still
+    arriving. `exhausted` tells when the whole stream has been consumed.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.exhausted = False
+
+    def __iter__(self):
+        pending = ''
+        for chunk in self.chunks:
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield line
+
+        if pending.strip():
+            yield pending
+        self.exhausted = True
+
+
+class ChunkStream:
+    """ chunks of an upload, `exhausted` tells when the last one has been read """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.exhausted = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield chunk
+        self.exhausted = True
+
+
+def peek(chunks, size):
+    """ first `size` bytes of a stream of chunks and the untouched stream """
+    chunks, head = iter(chunks), []
+
+    for chunk in chunks:
+        head.append(chunk)
+        if sum(len(i) for i in head) >= size:
+            break
+
+    return ''.join(head)[:size], itertools.chain(head, chunks)
+
+
+class RequestParser:
+    """
+    incremental reader of a request for non blocking sockets, bytes are fed as
+    they arrive. Framed bodies are copied into a single preallocated buffer.
+    """
+
+    def __init__(self, max_request_size=0):
+        self.max_request_size = max_request_size
+        self.pending = ''
+        self.flags = None
+        self.framed = None
+        self.body = None
+        self.received = 0
+        self.chunks = []
+        self.complete = False
+        # bytes of the next requests of a pipelining client
+        self.rest = ''
+
+    def feed(self, data):
+        """ returns True once the whole request has been received """
+        if self.framed is None:
+            self.pending += data
+            if len(self.pending) < len(FRAME_MAGIC):
+                return False
+            data, self.pending = self.pending, ''
+            self.framed = data.startswith(FRAME_MAGIC)
+
+        if self.framed:
+            self.feed_framed(data)
+        else:
+            self.feed_sentinel(data)
+
+        return self.complete
+
+    def feed_framed(self, data):
+        if self.body is None:
+            self.pending += data
+            if len(self.pending) < REQUEST_HEADER.size:
+                return
+            _, self.flags, length = REQUEST_HEADER.unpack(self.pending[:REQUEST_HEADER.size])
+            data, self.pending = self.pending[REQUEST_HEADER.size:], ''
+            check_request_size(length, self.max_request_size)
+            self.body = bytearray(length)
+
+        needed = len(self.body) - self.received
+        data, self.rest = data[:needed], data[needed:]
+        self.body[self.received:self.received + len(data)] = data
+        self.received += len(data)
+        self.complete = self.received == len(self.body)
+
+    def feed_sentinel(self, data):
+        """ only the new data and the tail of the previous one are checked """
+        tail = (self.pending + data)[-len(END_SEQUENCE):]
+        self.chunks.append(data)
+        self.received += len(data)
+        check_request_size(self.received - len(END_SEQUENCE), self.max_request_size)
+        self.pending = tail
+        if tail.endswith(END_SEQUENCE):
+            self.body = ''.join(self.chunks)[:-len(END_SEQUENCE)]
+            self.chunks = []
+            self.complete = True
+
+    def data(self):
+        return str(self.body)
+
+
+class ResponseParser:
+    """
+    incremental reader of framed responses for non blocking sockets, `feed`
+    returns the chunks completed by the new bytes, None ends a response.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        chunks, position = [], 0
+        while len(self.buffer) - position >= CHUNK_HEADER.size:
+            (length,) = CHUNK_HEADER.unpack_from(self.buffer, position)
+            start = position + CHUNK_HEADER.size
+            if len(self.buffer) - start < length:
+                break
+            chunks.append(str(self.buffer[start:start + length]) if length else None)
+            position = start + length
+
+        del self.buffer[:position]
+        return chunks
+
+
+class ResponseWriter:
+    def __init__(self, sock, framed):
+        self.socket = sock
+        self.framed = framed
+
+    @staticmethod
+    def frame(data, framed):
+        if framed:
+            return CHUNK_HEADER.pack(len(data)) + data
+        return data
+
+    @staticmethod
+    def end(framed):
+        if framed:
+            return CHUNK_HEADER.pack(0)
+        return END_SEQUENCE
+
+    def write(self, data):
+        # an empty framed chunk would end the response
+        if data:
+            self.socket.sendall(ResponseWriter.frame(data, self.framed))
+
+    def close(self):
+        self.socket.sendall(ResponseWriter.end(self.framed))
+
+
+class SpilledResponse:
+    """
+    encoded response held while the client is still uploading or not reading.
+    Past `threshold` bytes in memory ( 0 never ) it is appended to an anonymous
+    temporary file in order, the memory of the processor stays bounded whatever
+    the size of the request. The file is sent in blocks and then what is left in
+    memory, `drain` blocks until everything is sent and `send_ready` only sends
+    what the socket takes at once.
+    """
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, threshold, block_size=BLOCK_SIZE):
+        self.threshold = threshold
+        self.block_size = block_size
+        self.held = []
+        self.size = self.spilled = 0
+        self.file = None
+        # bytes written to and sent from the current file
+        self.written = self.read = 0
+        # framed block partially sent by `send_ready`
+        self.output = ''
+
+    def append(self, data):
+        self.held.append(data)
+        self.size += len(data)
+        if self.threshold and self.size > self.threshold:
+            self.spill()
+
+    def spill(self):
+        if self.file is None:
+            self.file = tempfile.TemporaryFile()
+        self.file.seek(self.written)
+        for data in self.held:
+            self.file.write(data)
+        self.spilled += self.size
+        self.written += self.size
+        self.held, self.size = [], 0
+
+    def next_block(self):
+        """ next block to send in order, '' when nothing is held """
+        if self.file is not None:
+            self.file.seek(self.read)
+            data = self.file.read(self.block_size)
+            self.read += len(data)
+            if self.read == self.written:
+                self.file.close()
+                self.file = None
+                self.written = self.read = 0
+            if data:
+                return data
+
+        data = ''.join(self.held)
+        self.held, self.size = [], 0
+        return data
+
+    def drain(self, writer):
+        if self.output:
+            writer.socket.sendall(self.output)
+            self.output = ''
+        for data in iter(self.next_block, ''):
+            writer.write(data)
+
+    def send_ready(self, writer):
+        """ sends blocks until the socket would block, True once nothing is held """
+        while True:
+            if not self.output:
+                data = self.next_block()
+                if not data:
+                    return True
+                self.output = writer.frame(data, writer.framed)
+            try:
+                sent = writer.socket.send(self.output, socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            self.output = self.output[sent:]
+
+
+class ResponseEncoder:
+    """ body of a response from its chunks of results, for the flags of the request """
+
+    def __init__(self, flags):
+        self.binary = flags & RESPONSE_FORMAT_MASK == RESPONSE_BINARY
+        self.compressor = zlib.compressobj() if flags & RESPONSE_ZLIB else None
+        self.separator = ''
+
+    def encode(self, chunk):
+        if self.binary:
+            data = ''.join(chunk)
+        else:
+            data = self.separator + "\n".join(chunk)
+            self.separator = '\n'
+
+        if self.compressor:
+            return self.compressor.compress(data)
+        return data
+
+    def flush(self):
+        if self.compressor:
+            return self.compressor.flush()
+        return ''
+
+
+class ResponseDecoder:
+    """ text of a response body encoded by a ResponseEncoder, one result per line """
+
+    def __init__(self, flags):
+        self.binary = flags & RESPONSE_FORMAT_MASK == RESPONSE_BINARY
+        self.decompressor = zlib.decompressobj() if flags & RESPONSE_ZLIB else None
+        self.pending = ''
+        self.separator = ''
+
+    def decode(self, data):
+        if self.decompressor:
+            data = self.decompressor.decompress(data)
+        return self.unpack(data)
+
+    def unpack(self, data):
+        if not self.binary:
+            return data
+
+        # packed results may be split between chunks
+        data = self.pending + data
+        size = len(data) - len(data) % PACKED_RESULT.size
+        self.pending = data[size:]
+        if not size:
+            return ''
+
+        values = struct.unpack('!%sd' % (size / PACKED_RESULT.size), data[:size])
+        text = self.separator + "\n".join('%s' % value for value in values)
+        self.separator = '\n'
+        return text
+
+    def flush(self):
+        if self.decompressor:
+            return self.unpack(self.decompressor.flush())
+        return ''
+
+
+def send_request(sock, data, framed, flags=0):
+    if framed:
+        sock.sendall(REQUEST_HEADER.pack(FRAME_MAGIC, flags, len(data)))
+        sock.sendall(data)
+    else:
+        sock.sendall(data)
+        sock.sendall(END_SEQUENCE)
+
+
+class ConnectionLog(logging.LoggerAdapter):
+    """
+    the logger of the service with the address of a connection before each
+    message: the processors forked for the connections share a single logger.
+    """
+
+    def __init__(self, logger, address):
+        logging.LoggerAdapter.__init__(self, logger, {'address': address})
+
+    def process(self, msg, kwargs):
+        return 'conn [ %s:%s ]:%s' % (self.extra['address'][0], self.extra['address'][1], msg), kwargs
+
+
 def get_log(name, verbose):
     if verbose:
         log_level = logging.DEBUG
@@ -48,7 +697,91 @@ def get_log(name, verbose):
     return logger
 
 
+class SevenZipStream:
+    """
+    decompressed data of every member of a 7z archive, yielded in chunks while
+    it is decoded and separated by a new line. Folders with a single lzma,
+    lzma2 or copy coder are streamed, the members of a solid folder share its
+    decompressor. Members with other coders are read whole.
+
+    py7zlib and pylzma are imported by the first archive, not by the service.
+    """
+
+    def __init__(self, stream, block_size=None):
+        import py7zlib
+        self.stream = stream
+        self.block_size = block_size or py7zlib.READ_BLOCKSIZE
+        self.archive = py7zlib.Archive7z(stream)
+        self.folder = self.decompressor = None
+        self.position = self.offset = 0
+        self.pending = ''
+
+    def __iter__(self):
+        separator = ''
+        for name in self.archive.getnames():
+            member = self.archive.getmember(name)
+            if not member.size:
+                continue
+            if separator:
+                yield separator
+            separator = '\n'
+
+            if self.streamed(member):
+                for chunk in self.member_chunks(member):
+                    yield chunk
+            else:
+                yield member.read()
+
+    @staticmethod
+    def streamed(member):
+        import py7zlib
+        coders = member._folder.coders
+        methods = (py7zlib.COMPRESSION_METHOD_LZMA, py7zlib.COMPRESSION_METHOD_LZMA2, py7zlib.COMPRESSION_METHOD_COPY)
+        return len(coders) == 1 and coders[0]['method'] in methods and not member._folder.isEncrypted()
+
+    def open_folder(self, member):
+        import py7zlib
+        import pylzma
+        coder = member._folder.coders[0]
+        self.folder, self.position, self.offset, self.pending = member._folder, 0, member._src_start, ''
+        self.decompressor = None
+        if coder['method'] != py7zlib.COMPRESSION_METHOD_COPY:
+            self.decompressor = pylzma.decompressobj(lzma2=coder['method'] == py7zlib.COMPRESSION_METHOD_LZMA2)
+            if coder.get('properties'):
+                self.decompressor.decompress(coder['properties'])
+
+    def decode(self):
+        """ next piece of the folder data, starting at `position` """
+        if self.pending:
+            data, self.pending = self.pending, ''
+            return data
+
+        self.stream.seek(self.offset)
+        data = self.stream.read(self.block_size)
+        self.offset += len(data)
+        decoded = self.decompressor.decompress(data) if self.decompressor else data
+        if not data and not decoded:
+            import py7zlib
+            raise py7zlib.DecompressionError('end of stream while decompressing')
+        return decoded
+
+    def member_chunks(self, member):
+        if self.folder is not member._folder or self.position > member._start:
+            self.open_folder(member)
+
+        start, end = member._start, member._start + member.size
+        while self.position < end:
+            data = self.decode()
+            skip = max(start - self.position, 0)
+            used = min(end - self.position, len(data))
+            self.pending = data[used:]
+            self.position += used
+            if used > skip:
+                yield data[skip:used]
+
+
 def descompress_7zip_stream(stream):
+    import py7zlib
     archive, output = py7zlib.Archive7z(stream), []
     for item in archive.getnames():
         data = archive.getmember(item).read()
@@ -8,3 +8,42 @@ default_socket_block_size = 1024 * 2
 
 # Arimethic params
 default_messages_per_child = 1000
+# children of the per request pools per cpu, shared by the requests in flight
+default_workers_per_cpu = 1
+# requests of this many lines or less are computed without forking children
+default_inline_lines = 100
+# lines sent to a worker at once, 0 means auto-tuned from the measured per-line cost
+default_messages_per_batch = 0
+# arithmetic operator implementation: classic or fast
+default_operator = 'fast'
+# a child of the per request pools dead or spending longer than the timeout ( seconds, 0 disables it ) on
+# a batch is replaced, the batch is sent again up to the retries times and then its lines get an error
+default_batch_timeout = 60
+default_batch_retries = 1
+
+# result caches ( number of results, 0 disables them ): one per worker and one shared by the service
+default_cache_size = 0
+default_shared_cache_size = 0
+
+# bytes of the largest request accepted, the connection of a larger one is closed ( 0 accepts any size )
+default_max_request_size = 2 * 1024 * 1024 * 1024
+
+# seconds a kept alive connection may wait for its next request before being closed ( 0 waits forever )
+default_idle_timeout = 60
+
+# bytes of a response held in memory while the client is still uploading, the rest is spilled to a
+# temporary file ( 0 holds it all in memory )
+default_spill_threshold = 64 * 1024 * 1024
+
+# persistent worker pool params ( 0 workers means computed from the number of cpus )
+default_pool_min_workers = 0
+default_pool_max_workers = 0
+default_jobs_per_worker = 100000
+
+# stage timings and counters of every process, dumped to the log every interval seconds ( 0 disables them )
+default_metrics_interval = 0
+default_metrics_file = None
+
+# coordinator: lines of the shards sent to the backends and times a failed shard is sent again
+default_shard_lines = 50000
+default_shard_retries = 2
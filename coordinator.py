@@ -0,0 +1,422 @@
+import collections
+import errno
+import logging
+import multiprocessing
+import re
+import select
+import socket
+import struct
+import time
+import unittest
+
+from algebra import PACKED_RESULT, RESPONSE_BINARY, RESPONSE_COMPACT, RESPONSE_VERBOSE
+from common import get_log, send_request, ConnectionClosedException, ConnectionLog, ResponseEncoder, ResponseParser
+from common import RequestTooLargeException, ResponseWriter, SocketReader, FRAME_MAGIC, REQUEST_HEADER
+from common import RESPONSE_FORMAT_MASK
+from eventloop import EventLoopService
+from input_codecs import decode_lines, CorruptInputException
+from workers import ArithmeticWorkerPool
+
+"""
+python service.py --port 12345 &
+python service.py --port 12346 --event_loop &
+python service.py --port 12300 --backends 127.0.0.1:12345,127.0.0.1:12346 --shard_lines 50000
+"""
+
+
+class ShardingProcessorTest(unittest.TestCase):
+    @staticmethod
+    def run_backend(service):
+        while 1:
+            service.poll_once()
+
+    def setUp(self):
+        log = logging.getLogger('test')
+        self.services, self.processes = [], []
+        for _ in range(2):
+            pool = ArithmeticWorkerPool(log, min_workers=1, max_workers=1, jobs_per_worker=1000, no_slots=2,
+                                        batch_size=2)
+            service = EventLoopService(log, '127.0.0.1', 0, 5, 1024, pool)
+            service.start()
+            p = multiprocessing.Process(target=self.run_backend, args=(service,))
+            p.start()
+            self.services.append(service)
+            self.processes.append(p)
+
+        # nothing listens on the port of a closed socket
+        dead = socket.socket()
+        dead.bind(('127.0.0.1', 0))
+        self.dead_port = dead.getsockname()[1]
+        dead.close()
+
+    def tearDown(self):
+        for p in self.processes:
+            p.terminate()
+            p.join()
+        for service in self.services:
+            service.stop()
+
+    def serve(self, data, flags, retries=2):
+        backends = [Backend('127.0.0.1:%s' % self.dead_port)]
+        backends += [Backend('127.0.0.1:%s' % service.port) for service in self.services]
+        server, client = socket.socketpair()
+        processor = ShardingProcessor(server, 1024, logging.getLogger('test'), backends, shard_lines=3,
+                                      shard_retries=retries)
+        send_request(client, data, True, flags)
+        client.shutdown(socket.SHUT_WR)
+        processor.do_job()
+        response = ''.join(SocketReader(client, 1024).recv_chunks(True))
+        client.close()
+        return response
+
+    def test_shards_merged_in_order(self):
+        operations = ["%s + 1" % n for n in range(10)] + ["3 ^ 2"]
+        response = self.serve('\n'.join(operations), RESPONSE_COMPACT)
+        expected = ["%s %s" % (n, n + 1.0) for n in range(10)]
+        self.assertEqual(expected + ["10 wrong char, at position 2, not in 1234567890+-*/ "], response.split('\n'))
+
+    def test_verbose_line_numbers(self):
+        lines = self.serve('\n'.join("%s * 2" % n for n in range(7)), RESPONSE_VERBOSE).split('\n')
+        self.assertEqual(["input_line[%s]: %s * 2 = %s " % (n, n, n * 2.0) for n in range(7)],
+                         [line.split('response, ')[1] for line in lines])
+
+    def test_binary(self):
+        response = self.serve('\n'.join("%s - 1" % n for n in range(5)), RESPONSE_BINARY)
+        self.assertEqual([n - 1.0 for n in range(5)], list(struct.unpack('!5d', response)))
+
+    def test_failed_shard_without_retries(self):
+        # the first shard goes to the dead backend
+        self.assertRaises(ConnectionClosedException, self.serve, '\n'.join(["1 + 1"] * 10), RESPONSE_COMPACT, 0)
+
+    def test_failed_shard_names_its_backend(self):
+        backends = [Backend('127.0.0.1:%s' % self.dead_port), Backend('127.0.0.1:%s' % self.services[0].port)]
+        processor = ShardingProcessor(socket.socket(), 1024, logging.getLogger('test'), backends, shard_lines=3,
+                                      shard_retries=0)
+        with self.assertRaises(ShardFailedException) as context:
+            list(processor.fan_out(["1 + 1"] * 10, RESPONSE_COMPACT))
+        self.assertTrue(str(backends[0]) in str(context.exception))
+
+    def test_health_check(self):
+        self.assertTrue(Backend('127.0.0.1:%s' % self.services[0].port).check(1))
+        self.assertFalse(Backend('127.0.0.1:%s' % self.dead_port).check(1))
+
+
+class ShardFailedException(Exception):
+    pass
+
+
+class Backend:
+    """
+    a service.py instance shards are sent to. `healthy` is shared by the
+    coordinator, that checks the backends periodically, and its processors.
+    """
+
+    def __init__(self, address):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.healthy = multiprocessing.Value('b', 1, lock=False)
+        self.in_flight = 0
+
+    def __str__(self):
+        return '%s:%s' % self.address
+
+    def check(self, timeout):
+        """ True when the backend answers an empty request """
+        try:
+            sock = socket.create_connection(self.address, timeout)
+            try:
+                send_request(sock, '', True)
+                return not list(SocketReader(sock, 1024).recv_chunks(True))
+            finally:
+                sock.close()
+        except (socket.error, ConnectionClosedException, struct.error):
+            return False
+
+
+class ShardRequest:
+    """
+    a shard of the lines of a request sent to a backend through a non blocking
+    framed connection. `read` returns the results received, split one per line
+    or per packed double, with the line numbers of the whole request.
+    """
+    LINE_NUMBER = re.compile(r'input_line\[(\d+)\]')
+
+    def __init__(self, index, offset, lines, backend, response_format, skip, block_size, timeout):
+        self.index = index
+        self.offset = offset
+        self.backend = backend
+        self.response_format = response_format
+        # results already received from a previous attempt
+        self.skip = skip
+        self.block_size = block_size
+        self.timeout = timeout
+        self.deadline = time.time() + timeout
+
+        body = '\n'.join(lines)
+        self.output = REQUEST_HEADER.pack(FRAME_MAGIC, response_format, len(body)) + body
+        self.sent = 0
+        self.parser = ResponseParser()
+        self.pending = ''
+        self.done = False
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setblocking(0)
+        self.socket.connect_ex(backend.address)
+        backend.in_flight += 1
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def writing(self):
+        return self.sent < len(self.output)
+
+    def write(self):
+        try:
+            self.sent += self.socket.send(memoryview(self.output)[self.sent:self.sent + self.block_size])
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def read(self):
+        try:
+            data = self.socket.recv(self.block_size)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise
+
+        if not data:
+            raise ConnectionClosedException('backend %s closed the connection' % self.backend)
+        self.deadline = time.time() + self.timeout
+
+        results = []
+        for chunk in self.parser.feed(data):
+            if chunk is None:
+                self.done = True
+                if self.pending:
+                    results.append(self.pending)
+                break
+            results.extend(self.split(chunk))
+
+        skipped = min(self.skip, len(results))
+        self.skip -= skipped
+        return [self.renumber(result) for result in results[skipped:]]
+
+    def split(self, chunk):
+        data = self.pending + chunk
+        if self.response_format == RESPONSE_BINARY:
+            size = len(data) - len(data) % PACKED_RESULT.size
+            self.pending = data[size:]
+            return [data[i:i + PACKED_RESULT.size] for i in range(0, size, PACKED_RESULT.size)]
+
+        results = data.split('\n')
+        self.pending = results.pop()
+        return results
+
+    def renumber(self, result):
+        if not self.offset or self.response_format == RESPONSE_BINARY:
+            return result
+        if self.response_format == RESPONSE_COMPACT:
+            n, value = result.split(' ', 1)
+            return '%s %s' % (int(n) + self.offset, value)
+
+        return ShardRequest.LINE_NUMBER.sub(lambda m: 'input_line[%s]' % (int(m.group(1)) + self.offset), result, 1)
+
+    def close(self):
+        self.socket.close()
+        self.backend.in_flight -= 1
+
+
+class ShardingProcessor:
+    """
+    serves the connection of a client of the coordinator: the lines of each
+    request are split in shards of `shard_lines`, at most `shards_per_backend`
+    of them are computed by each backend at a time, and the results are
+    written back in input order as soon as the shards before them are done.
+
+    A shard whose backend fails or stays silent for `timeout` seconds is sent
+    again to another backend, up to `shard_retries` times.
+    """
+
+    def __init__(self, client_socket, block_size, log, backends, shard_lines, shard_retries, shards_per_backend=2,
+                 timeout=60, max_request_size=0):
+        self.socket = client_socket
+        self.reader = SocketReader(client_socket, block_size, max_request_size)
+        self.block_size = block_size
+        self.log = log
+        self.backends = backends
+        self.shard_lines = shard_lines
+        self.shard_retries = shard_retries
+        self.shards_per_backend = shards_per_backend
+        self.timeout = timeout
+
+    def pick_backend(self, in_flight):
+        """ the healthy backend with less shards in flight, any backend if none looks healthy """
+        backends = [b for b in self.backends if b.in_flight < self.shards_per_backend]
+        healthy = [b for b in backends if b.healthy.value]
+        if healthy:
+            return min(healthy, key=lambda b: b.in_flight)
+        if backends and not in_flight:
+            return min(backends, key=lambda b: b.in_flight)
+        return None
+
+    def fail(self, request, error, attempts, pending):
+        request.close()
+        request.backend.healthy.value = 0
+        attempts[request.index] += 1
+        self.log.info(' * shard %s failed on %s ( attempt %s ): %s' %
+                      (request.index, request.backend, attempts[request.index], error))
+        if attempts[request.index] > self.shard_retries:
+            raise ShardFailedException('shard %s failed on %s after %s attempts: %s' %
+                                       (request.index, request.backend, attempts[request.index], error))
+        pending.appendleft(request.index)
+
+    def fan_out(self, lines, response_format):
+        """ chunks of results of all the shards, in input order """
+        no_shards = -(-len(lines) // self.shard_lines)
+        pending = collections.deque(range(no_shards))
+        attempts, received = [0] * no_shards, [0] * no_shards
+        held, done, in_flight = {}, set(), {}
+        head = 0
+
+        while head < no_shards:
+            while pending:
+                backend = self.pick_backend(in_flight)
+                if backend is None:
+                    break
+                index = pending.popleft()
+                offset = index * self.shard_lines
+                request = ShardRequest(index, offset, lines[offset:offset + self.shard_lines], backend,
+                                       response_format, received[index], self.block_size, self.timeout)
+                in_flight[request.fileno()] = request
+
+            if not in_flight:
+                raise ShardFailedException('no backend available for %s shards' % len(pending))
+
+            writers = [r for r in in_flight.values() if r.writing()]
+            timeout = max(0, min(r.deadline for r in in_flight.values()) - time.time())
+            readable, writable, _ = select.select(list(in_flight.values()), writers, [], timeout)
+
+            for request in set(readable + writable):
+                try:
+                    if request in writable:
+                        request.write()
+                    results = request.read() if request in readable else []
+                except (socket.error, ConnectionClosedException) as e:
+                    del in_flight[request.fileno()]
+                    self.fail(request, e, attempts, pending)
+                    continue
+
+                received[request.index] += len(results)
+                if results and request.index == head:
+                    yield results
+                elif results:
+                    held.setdefault(request.index, []).extend(results)
+
+                if request.done:
+                    del in_flight[request.fileno()]
+                    request.close()
+                    done.add(request.index)
+
+            for request in [r for r in in_flight.values() if r.deadline < time.time()]:
+                del in_flight[request.fileno()]
+                self.fail(request, ShardFailedException('no answer in %s s' % self.timeout), attempts, pending)
+
+            while head in done:
+                head += 1
+                if head in held:
+                    yield held.pop(head)
+
+    def do_job(self):
+        self.log.info(' * coordinating ...')
+        try:
+            while True:
+                flags, length, prefix = self.reader.recv_header()
+                framed = flags is not None
+                flags = flags or 0
+                lines, data_format = decode_lines(''.join(self.reader.iter_body(length, prefix)))
+                self.log.info(' * %s request: %s lines, data format found: %s, %s shards' %
+                              ('framed' if framed else 'sentinel', len(lines), data_format,
+                               -(-len(lines) // self.shard_lines)))
+
+                writer, encoder = ResponseWriter(self.socket, framed), ResponseEncoder(flags)
+                for results in self.fan_out(lines, flags & RESPONSE_FORMAT_MASK):
+                    writer.write(encoder.encode(results))
+                writer.write(encoder.flush())
+                writer.close()
+
+                if not framed or self.reader.closed():
+                    break
+        except ConnectionClosedException as ex:
+            self.log.info(' * connection lost: %s' % ex)
+        except (RequestTooLargeException, CorruptInputException) as ex:
+            self.log.warning(' * request rejected: %s' % ex)
+        except (ShardFailedException, socket.error) as ex:
+            # the client sees the connection closed before the end of the response
+            self.log.critical(' * request failed: %s' % ex)
+        self.socket.close()
+        self.log.info(' * end coordinator processor ...')
+
+
+class CoordinatorService:
+    """
+    front end of several service.py instances: every connection is served by
+    a ShardingProcessor in a new process. The backends are checked every
+    HEALTH_INTERVAL seconds, the shards only go to the healthy ones.
+    """
+    MAINTENANCE_INTERVAL = 0.5
+    HEALTH_INTERVAL = 5
+    HEALTH_TIMEOUT = 1
+
+    def __init__(self, verbose, ip_address, port, no_sockets, block_size, backends, shard_lines, shard_retries,
+                 max_request_size=0):
+        self.verbose = verbose
+        self.max_request_size = max_request_size
+        self.log = get_log('Blueliv-Coordinator', verbose)
+        self.ip_address = ip_address
+        self.port = port
+        self.no_sockets = no_sockets
+        self.block_size = block_size
+        self.backends = [Backend(address) for address in backends]
+        self.shard_lines = shard_lines
+        self.shard_retries = shard_retries
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.last_check = 0
+
+    def check_backends(self):
+        for backend in self.backends:
+            healthy = backend.check(CoordinatorService.HEALTH_TIMEOUT)
+            if healthy != bool(backend.healthy.value):
+                self.log.info(' * backend %s is %s' % (backend, 'up' if healthy else 'down'))
+            backend.healthy.value = healthy
+        self.last_check = time.time()
+
+    def launch_process_message(self, client_socket, address):
+        processor = ShardingProcessor(client_socket, self.block_size, ConnectionLog(self.log, address), self.backends,
+                                      self.shard_lines, self.shard_retries, max_request_size=self.max_request_size)
+        p = multiprocessing.Process(target=processor.do_job)
+        p.start()
+        client_socket.close()
+
+    def run(self):
+        self.socket.bind((self.ip_address, self.port))
+        self.socket.listen(self.no_sockets)
+        self.socket.settimeout(CoordinatorService.MAINTENANCE_INTERVAL)
+        self.log.info('  *** coordinator running [ %s:%s ] backends: %s ***' %
+                      (self.ip_address, self.port, ', '.join(str(b) for b in self.backends)))
+
+        while 1:
+            if time.time() - self.last_check > CoordinatorService.HEALTH_INTERVAL:
+                self.check_backends()
+            try:
+                (client_socket, address) = self.socket.accept()
+            except socket.timeout:
+                continue
+
+            client_socket.settimeout(None)
+            self.log.info('connetion accepetd %s' % str(address))
+            self.launch_process_message(client_socket, address)
+
+    def stop(self):
+        self.socket.close()
+        self.log.info(' *** coordinator stopped ***')
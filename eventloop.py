@@ -0,0 +1,415 @@
+import collections
+import errno
+import logging
+import select
+import socket
+import time
+import unittest
+
+import metrics
+from algebra import RESPONSE_BINARY, RESPONSE_COMPACT
+from common import send_request, ConnectionClosedException, RequestParser, RequestTooLargeException, ResponseDecoder
+from common import ResponseEncoder, ResponseWriter, SocketReader, RESPONSE_FORMAT_MASK, RESPONSE_ZLIB
+from input_codecs import decode_lines
+from workers import ArithmeticWorkerPool, PoolRequest
+
+"""
+python service.py --event_loop --verbose --port 12345 --host 127.0.0.1
+"""
+
+
+class EventLoopServiceTest(unittest.TestCase):
+    def setUp(self):
+        log = logging.getLogger('test')
+        pool = ArithmeticWorkerPool(log, min_workers=1, max_workers=2, jobs_per_worker=1000, no_slots=1,
+                                    scale_up_depth=10, batch_size=2)
+        self.service = EventLoopService(log, '127.0.0.1', 0, 5, 1024, pool)
+        self.service.start()
+
+    def tearDown(self):
+        self.service.stop()
+
+    def serve(self, requests, flags=0):
+        """ sends every request, runs the loop until all of them are answered and returns the responses """
+        sockets = []
+        for data, framed in requests:
+            sock = socket.create_connection(('127.0.0.1', self.service.port))
+            send_request(sock, data, framed, flags)
+            # framed connections are kept open for more requests until the client is done
+            sock.shutdown(socket.SHUT_WR)
+            sockets.append((sock, framed))
+            self.service.poll_once()
+
+        deadline = time.time() + 10
+        while self.service.connections and time.time() < deadline:
+            self.service.poll_once()
+
+        responses = []
+        for sock, framed in sockets:
+            decoder = ResponseDecoder(flags if framed else 0)
+            chunks = SocketReader(sock, 1024).recv_chunks(framed)
+            responses.append(''.join(decoder.decode(chunk) for chunk in chunks) + decoder.flush())
+            sock.close()
+        return responses
+
+    def test_concurrent_requests(self):
+        # a single result slot, the second connection waits for the first one
+        framed, sentinel = self.serve([("3 + 4\n2 * 3\n1 + 1", True), ("6 / 2\n\n5 - 8", False)])
+        self.assertEqual(3, len(framed.split('\n')))
+        self.assertTrue(framed.split('\n')[2].endswith('input_line[2]: 1 + 1 = 2.0 '))
+        self.assertEqual(2, len(sentinel.split('\n')))
+        self.assertTrue(sentinel.split('\n')[1].endswith('input_line[1]: 5 - 8 = -3.0 '))
+        self.assertEqual([0], self.service.free_slots)
+
+    def test_compressed_binary_response(self):
+        response = self.serve([("3 + 4\n1 / 0\n2 * 3", True)], RESPONSE_BINARY | RESPONSE_ZLIB)
+        self.assertEqual(["7.0", "nan", "6.0"], response[0].split('\n'))
+
+    def test_pipelined_requests(self):
+        sock = socket.create_connection(('127.0.0.1', self.service.port))
+        send_request(sock, "3 + 4", True)
+        send_request(sock, "2 * 3\n1 + 1", True, RESPONSE_COMPACT)
+        sock.shutdown(socket.SHUT_WR)
+        self.service.poll_once()
+
+        deadline = time.time() + 10
+        while self.service.connections and time.time() < deadline:
+            self.service.poll_once()
+
+        reader = SocketReader(sock, 1024)
+        self.assertTrue(''.join(reader.recv_chunks(True)).endswith('input_line[0]: 3 + 4 = 7.0 '))
+        self.assertEqual("0 6.0\n1 2.0", ''.join(reader.recv_chunks(True)))
+        sock.close()
+
+    def test_corrupt_upload_closes_its_connection_only(self):
+        sock = socket.create_connection(('127.0.0.1', self.service.port))
+        send_request(sock, '\x1f\x8b' + 'x' * 40, True)
+        deadline = time.time() + 10
+        while not self.service.connections and time.time() < deadline:
+            self.service.poll_once()
+        while self.service.connections and time.time() < deadline:
+            self.service.poll_once()
+        self.assertEqual('', sock.recv(1024))
+        sock.close()
+        self.assertTrue(self.serve([("3 + 4", True)])[0].endswith('input_line[0]: 3 + 4 = 7.0 '))
+
+    def test_closed_connection_leaves_the_queue(self):
+        connection = ClientConnection(socket.socket(), ('127.0.0.1', 0), 1024)
+        self.service.connections[connection.fd] = connection
+        self.service.poller.register(connection.fd, EventLoopService.READ_EVENTS)
+        self.service.waiting.append(connection)
+        self.service.close(connection)
+        self.assertEqual(0, len(self.service.waiting))
+
+    def test_empty_request(self):
+        self.assertEqual([''], self.serve([("\n", True)]))
+
+
+class ClientConnection:
+    """ state of a client socket served by the event loop """
+
+    def __init__(self, sock, address, block_size, max_request_size=0):
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.block_size = block_size
+        self.max_request_size = max_request_size
+        self.parser = RequestParser(max_request_size)
+        self.output = collections.deque()
+        self.encoder = None
+        self.lines = None
+        self.slot = None
+        self.busy = False
+        self.closing = False
+        self.started = None
+
+    def fileno(self):
+        return self.fd
+
+    def reading(self):
+        """ requests are read one at a time, the next one once the response of the previous is queued """
+        return not self.busy and not self.closing
+
+    def read(self):
+        """ returns True once the whole request has been received """
+        try:
+            data = self.socket.recv(self.block_size)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+
+        if not data:
+            raise ConnectionClosedException('connection closed by %s:%s' % self.address)
+        return self.feed(data)
+
+    def feed(self, data):
+        if not self.parser.feed(data):
+            return False
+
+        self.busy = True
+        self.encoder = ResponseEncoder(self.flags())
+        return True
+
+    def flags(self):
+        return self.parser.flags or 0
+
+    def queue(self, data):
+        # an empty framed chunk would end the response
+        if data:
+            self.output.append(ResponseWriter.frame(data, self.parser.framed))
+
+    def queue_chunks(self, chunks):
+        for chunk in chunks:
+            self.queue(self.encoder.encode(chunk))
+
+    def end_request(self):
+        """
+        queues the end of the response. Sentinel connections are closed after
+        it, framed ones go on with the next request: returns True when the
+        bytes already received complete it.
+        """
+        self.queue(self.encoder.flush())
+        self.output.append(ResponseWriter.end(self.parser.framed))
+        self.busy = False
+        if not self.parser.framed:
+            self.closing = True
+            return False
+
+        rest, self.parser = self.parser.rest, RequestParser(self.max_request_size)
+        return self.feed(rest)
+
+    def write(self):
+        """ sends what the socket accepts, returns True when nothing is left """
+        while self.output:
+            data = self.output[0]
+            try:
+                sent = self.socket.send(data)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+
+            if sent < len(data):
+                self.output[0] = data[sent:]
+                return False
+            self.output.popleft()
+
+        return True
+
+
+class EventLoopService:
+    """
+    Single process front end: the connections are multiplexed by a poll loop
+    that reads the requests, feeds their lines to an ArithmeticWorkerPool and
+    writes the results back in input order as soon as they arrive, instead of
+    forking a processor per connection.
+
+    The loop owns all the result slots of the pool, a request waits in a queue
+    until one is free. The slot of a client gone away is kept until the batches
+    it has in flight are drained.
+    """
+    MAINTENANCE_INTERVAL = 0.5
+    READ_EVENTS = select.POLLIN | select.POLLPRI
+
+    def __init__(self, log, ip_address, port, no_sockets, block_size, pool, max_request_size=0):
+        self.log = log
+        self.max_request_size = max_request_size
+        self.ip_address = ip_address
+        self.port = port
+        self.no_sockets = no_sockets
+        self.block_size = block_size
+        self.pool = pool
+        # the loop reads the result channels, a full one would block it writing there
+        self.pool.failure_handler = self.batch_failed
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.poller = select.poll()
+
+        self.connections = {}
+        self.channels = {}
+        self.requests = {}
+        self.owners = {}
+        self.free_slots = list(range(len(pool.result_channels)))
+        self.waiting = collections.deque()
+        self.last_maintenance = time.time()
+
+    def start_listenning(self):
+        self.socket.bind((self.ip_address, self.port))
+        self.socket.listen(max(self.no_sockets, socket.SOMAXCONN))
+        self.socket.setblocking(0)
+        self.port = self.socket.getsockname()[1]
+        self.poller.register(self.socket.fileno(), EventLoopService.READ_EVENTS)
+
+    def start(self):
+        self.start_listenning()
+        self.pool.start()
+        for slot, channel in enumerate(self.pool.result_channels):
+            self.channels[channel.reader.fileno()] = slot
+            self.poller.register(channel.reader.fileno(), EventLoopService.READ_EVENTS)
+        self.log.info('  *** event loop server running [ %s:%s ] ***' % (self.ip_address, self.port))
+
+    def run(self):
+        self.start()
+        while 1:
+            self.poll_once()
+
+    def stop(self):
+        for connection in list(self.connections.values()):
+            self.close(connection)
+        self.socket.close()
+        self.pool.shutdown()
+        if metrics.COLLECTOR:
+            metrics.collect()
+            metrics.COLLECTOR.dump()
+        self.log.info(' *** server stopped ***')
+
+    def poll_once(self, timeout=MAINTENANCE_INTERVAL):
+        for fd, event in self.poller.poll(timeout * 1000):
+            if fd == self.socket.fileno():
+                self.accept()
+            elif fd in self.channels:
+                self.receive(self.channels[fd])
+            elif fd in self.connections:
+                self.handle(self.connections[fd], event)
+
+        if time.time() - self.last_maintenance > EventLoopService.MAINTENANCE_INTERVAL:
+            self.pool.maintain()
+            metrics.collect()
+            self.last_maintenance = time.time()
+
+    def accept(self):
+        try:
+            (client_socket, address) = self.socket.accept()
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+
+        self.log.info('connetion accepetd %s' % str(address))
+        client_socket.setblocking(0)
+        connection = ClientConnection(client_socket, address, self.block_size, self.max_request_size)
+        self.connections[connection.fileno()] = connection
+        self.poller.register(connection.fileno(), EventLoopService.READ_EVENTS)
+
+    def update(self, connection):
+        """ poll events wanted by the connection """
+        events = select.POLLOUT if connection.output else 0
+        if connection.reading():
+            events |= EventLoopService.READ_EVENTS
+        self.poller.modify(connection.fileno(), events)
+
+    def handle(self, connection, event):
+        try:
+            if event & EventLoopService.READ_EVENTS and connection.reading() and connection.read():
+                self.request_received(connection)
+                if self.closed(connection):
+                    return
+            if event & select.POLLOUT and connection.write() and connection.closing:
+                self.close(connection)
+            elif event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                self.close(connection)
+            else:
+                self.update(connection)
+        except ConnectionClosedException:
+            # nothing else comes from the client, the responses queued are still sent
+            connection.closing = True
+            if connection.output:
+                self.update(connection)
+            else:
+                self.close(connection)
+        except socket.error as e:
+            self.log.info('connection %s lost: %s' % (str(connection.address), e))
+            self.close(connection)
+        except (RequestTooLargeException, MemoryError) as e:
+            self.log.warning('connection %s request rejected: %s' % (str(connection.address), e))
+            self.close(connection)
+
+    def request_received(self, connection):
+        connection.started = time.time()
+        try:
+            with metrics.timer('decompress'):
+                connection.lines, data_format = decode_lines(connection.parser.data())
+        except Exception as e:
+            # a corrupt upload only ends its own connection
+            self.log.warning('connection %s request not decoded: %r' % (str(connection.address), e))
+            self.close(connection)
+            return
+        metrics.count('requests')
+        metrics.count('lines', len(connection.lines))
+        self.log.info(' * %s request from %s: %s lines, data format found: %s' %
+                      ('framed' if connection.parser.framed else 'sentinel', str(connection.address),
+                       len(connection.lines), data_format))
+        self.update(connection)
+
+        if self.free_slots:
+            self.start_request(connection)
+        else:
+            self.waiting.append(connection)
+
+    def start_request(self, connection):
+        slot = self.free_slots.pop()
+        request = PoolRequest(self.pool, slot, connection.lines, connection.flags() & RESPONSE_FORMAT_MASK)
+        connection.lines, connection.slot = None, slot
+        self.requests[slot], self.owners[slot] = request, connection
+        request.dispatch()
+        self.forward(slot, [])
+
+    def receive(self, slot):
+        response = self.pool.result_channels[slot].recv()
+        if slot in self.requests:
+            self.forward(slot, self.requests[slot].receive(response))
+
+    def batch_failed(self, slot, failure):
+        """ a batch of the slot the pool will not answer, handled as its response """
+        if slot in self.requests:
+            self.forward(slot, self.requests[slot].receive(failure))
+
+    def forward(self, slot, chunks):
+        """ queues the ready chunks on the owner of the slot, the slot is released once the request ends """
+        request, connection = self.requests[slot], self.owners[slot]
+        finished = request.finished()
+        if finished:
+            self.release(slot)
+        if connection is None:
+            return
+
+        with metrics.timer('encode'):
+            connection.queue_chunks(chunks)
+        if finished:
+            metrics.observe('request', time.time() - connection.started)
+        if finished and connection.end_request():
+            # a pipelining client has already sent the whole next request
+            self.request_received(connection)
+        else:
+            self.update(connection)
+
+    def release(self, slot):
+        del self.requests[slot]
+        connection = self.owners.pop(slot)
+        if connection is not None:
+            connection.slot = None
+        self.free_slots.append(slot)
+
+        while self.waiting and self.free_slots:
+            connection = self.waiting.popleft()
+            if not self.closed(connection):
+                self.start_request(connection)
+
+    def closed(self, connection):
+        """ the fd of a closed connection may already belong to a new one """
+        return self.connections.get(connection.fileno()) is not connection
+
+    def close(self, connection):
+        fd = connection.fileno()
+        self.poller.unregister(fd)
+        del self.connections[fd]
+        connection.socket.close()
+        if connection in self.waiting:
+            self.waiting.remove(connection)
+
+        if connection.slot is not None:
+            self.owners[connection.slot] = None
+            self.requests[connection.slot].abandon()
+            if self.requests[connection.slot].finished():
+                self.release(connection.slot)
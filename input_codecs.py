@@ -0,0 +1,185 @@
+import StringIO
+import struct
+import unittest
+import zlib
+
+from common import descompress_7zip_file, LineStream, SevenZipStream, SEVENZIP_MAGIC
+
+
+class InputCodecsTest(unittest.TestCase):
+    def decode(self, data, size=7):
+        codec = find_codec(data)
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        return codec.name, ''.join(codec.decode(iter(chunks)))
+
+    def test_text(self):
+        self.assertEqual(('text', '3 + 4\n2 * 3'), self.decode('3 + 4\n2 * 3'))
+
+    def test_gzip_members(self):
+        import gzip
+        data = ''
+        for text in ('3 + 4\n', '2 * 3'):
+            output = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=output, mode='wb') as gzip_file:
+                gzip_file.write(text)
+            data += output.getvalue()
+        self.assertEqual(('gzip', '3 + 4\n2 * 3'), self.decode(data))
+
+    def test_bz2_members(self):
+        import bz2
+        data = bz2.compress('3 + 4\n') + bz2.compress('2 * 3')
+        self.assertEqual(('bz2', '3 + 4\n2 * 3'), self.decode(data, size=len(bz2.compress('3 + 4\n'))))
+
+    def test_7zip(self):
+        with open('operations.7z', 'rb') as file7z:
+            lines, data_format = decode_lines(file7z.read())
+        self.assertEqual('7z', data_format)
+        self.assertEqual(list(LineStream(descompress_7zip_file('operations.7z'))), lines)
+
+    def test_7zip_magic_without_archive(self):
+        self.assertRaises(CorruptInputException, decode_lines, SEVENZIP_MAGIC + '3 + 4')
+
+    def test_corrupt_gzip(self):
+        self.assertRaises(CorruptInputException, decode_lines, '\x1f\x8b' + 'x' * 40)
+
+    def test_truncated_members(self):
+        import bz2
+        import gzip
+        text = '\n'.join(str(n) for n in range(2000))
+        output = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=output, mode='wb') as gzip_file:
+            gzip_file.write(text)
+        for data in (output.getvalue(), bz2.compress(text)):
+            self.assertEqual(2000, len(decode_lines(data)[0]))
+            for end in (len(data) // 2, len(data) - 4):
+                self.assertRaises(CorruptInputException, decode_lines, data[:end])
+
+    def test_corrupt_7zip_body(self):
+        with open('operations.7z', 'rb') as file7z:
+            data = file7z.read()
+        corrupt = data[:1000] + ''.join(chr(ord(c) ^ 0x55) for c in data[1000:1200]) + data[1200:]
+        self.assertRaises(CorruptInputException, decode_lines, corrupt)
+
+
+class CorruptInputException(Exception):
+    pass
+
+
+class InputCodec:
+    """
+    compressed input format recognized by the magic bytes at the start of the
+    payload. `decode` turns an iterable of compressed chunks into an iterable
+    of decompressed ones, it imports the decompression modules it needs the
+    first time a payload of its format is seen.
+    """
+
+    def __init__(self, name, magic, decode):
+        self.name = name
+        self.magic = magic
+        self.decode = decode
+
+
+INPUT_CODECS = []
+TEXT_CODEC = InputCodec('text', '', iter)
+
+
+def register_codec(name, magic, decode):
+    INPUT_CODECS.append(InputCodec(name, magic, decode))
+
+
+def find_codec(head):
+    """ codec of a payload starting by `head`, plain text when no magic matches """
+    for codec in INPUT_CODECS:
+        if head.startswith(codec.magic):
+            return codec
+
+    return TEXT_CODEC
+
+
+def decompress_chunks(chunks, new_decompressor, ended):
+    """
+    chunks of a stream of concatenated zlib or bz2 members, decompressed as they
+    arrive. A stream whose last member does not reach its end is truncated.
+    """
+    decompressor = new_decompressor()
+    for chunk in chunks:
+        while chunk:
+            try:
+                data = decompressor.decompress(chunk)
+            except EOFError:
+                # bz2 members end exactly with the previous chunk
+                decompressor = new_decompressor()
+                continue
+            except (zlib.error, IOError) as e:
+                raise CorruptInputException('corrupt compressed input: %s' % e)
+
+            if data:
+                yield data
+
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = new_decompressor()
+
+    if not ended(decompressor):
+        raise CorruptInputException('truncated compressed input')
+
+    if hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def zlib_ended(decompressor):
+    """ a zlib stream past its end, trailer included, leaves the data fed to it unused """
+    probe = decompressor.copy()
+    try:
+        probe.decompress('\0')
+    except zlib.error:
+        return False
+    return bool(probe.unused_data)
+
+
+def bz2_ended(decompressor):
+    """ a bz2 stream refuses any data once it reached its end """
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        return True
+    return False
+
+
+def gunzip_chunks(chunks):
+    return decompress_chunks(chunks, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), zlib_ended)
+
+
+def bunzip2_chunks(chunks):
+    import bz2
+    return decompress_chunks(chunks, bz2.BZ2Decompressor, bz2_ended)
+
+
+def un7zip_chunks(chunks):
+    """ 7z archives need random access, the payload is gathered before decompressing it """
+    import py7zlib
+    data = ''.join(chunks)
+    try:
+        archive = SevenZipStream(StringIO.StringIO(data))
+    except (py7zlib.ArchiveError, struct.error) as e:
+        raise CorruptInputException('corrupt 7z archive: %r' % e)
+
+    try:
+        for chunk in archive:
+            yield chunk
+    except (py7zlib.ArchiveError, struct.error, ValueError) as e:
+        # a valid header does not make a valid body
+        raise CorruptInputException('corrupt 7z archive: %r' % e)
+
+
+register_codec('7z', SEVENZIP_MAGIC, un7zip_chunks)
+register_codec('gzip', '\x1f\x8b', gunzip_chunks)
+register_codec('bz2', 'BZh', bunzip2_chunks)
+
+
+def decode_lines(data):
+    """ non blank lines of a payload in any of the input formats, and the format found """
+    codec = find_codec(data)
+    return list(LineStream(codec.decode([data]))), codec.name
@@ -0,0 +1,282 @@
+import collections
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+import unittest
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+
+class HistogramTest(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = Histogram()
+        for seconds in [0.001] * 90 + [0.1] * 10:
+            histogram.observe(seconds)
+        self.assertEqual(100, histogram.count)
+        self.assertTrue(0.001 <= histogram.percentile(50) < 0.002)
+        self.assertTrue(0.1 <= histogram.percentile(99) < 0.2)
+        self.assertEqual(0.1, histogram.max)
+
+    def test_merge(self):
+        a, b = Histogram(), Histogram()
+        a.observe(0.001)
+        b.observe(0.5)
+        a.merge(b.snapshot())
+        self.assertEqual((2, 0.5), (a.count, a.max))
+        self.assertAlmostEqual(0.501, a.total)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_nested_streams_are_exclusive(self):
+        metrics = Metrics()
+
+        def slow(items, seconds):
+            for item in items:
+                time.sleep(seconds)
+                yield item
+
+        inner = metrics.timed('inner', slow(range(5), 0.01))
+        self.assertEqual(list(range(5)), list(metrics.timed('outer', slow(inner, 0.02))))
+        self.assertTrue(0.04 <= metrics.histograms['inner'].total < 0.09)
+        self.assertTrue(0.09 <= metrics.histograms['outer'].total < 0.14)
+
+    def test_forked_copies_start_empty(self):
+        metrics = Metrics()
+        metrics.count('requests')
+        metrics.pid = -1
+        metrics.count('lines', 3)
+        self.assertEqual({'lines': 3}, metrics.snapshot()['counters'])
+
+    def test_aggregated_across_processes(self):
+        queue = multiprocessing.Queue()
+        collector = MetricsCollector(queue, logging.getLogger('test'), 0)
+
+        def work():
+            REGISTRY.count('requests')
+            with REGISTRY.timer('compute'):
+                pass
+            REGISTRY.flush(queue)
+
+        processes = [multiprocessing.Process(target=work) for _ in range(2)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+
+        deadline = time.time() + 5
+        while collector.totals.counters['requests'] < 2 and time.time() < deadline:
+            collector.poll()
+        self.assertEqual(2, collector.totals.counters['requests'])
+        self.assertEqual(2, collector.totals.histograms['compute'].count)
+
+
+class Histogram:
+    """
+    durations in exponential buckets, from 0.1 ms doubling up to about 14 minutes.
+    Percentiles are the upper bound of the bucket they fall in, or the maximum.
+    """
+    BOUNDS = [0.0001 * 2 ** k for k in range(24)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(Histogram.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        bucket = 0
+        while bucket < len(Histogram.BOUNDS) and seconds > Histogram.BOUNDS[bucket]:
+            bucket += 1
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        rank, seen = p / 100.0 * self.count, 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(Histogram.BOUNDS[bucket], self.max) if bucket < len(Histogram.BOUNDS) else self.max
+        return 0.0
+
+    def snapshot(self):
+        return {'buckets': list(self.buckets), 'count': self.count, 'total': self.total, 'max': self.max}
+
+    def merge(self, snapshot):
+        self.buckets = [a + b for a, b in zip(self.buckets, snapshot['buckets'])]
+        self.count += snapshot['count']
+        self.total += snapshot['total']
+        self.max = max(self.max, snapshot['max'])
+
+    def summary(self):
+        return {'count': self.count, 'total': self.total, 'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(50), 'p95': self.percentile(95), 'p99': self.percentile(99), 'max': self.max}
+
+
+class Metrics:
+    """
+    counters and duration histograms of one process. Stage timers nest: the
+    time of a stage excludes the stages running inside it, so a line stream
+    pulling a decompressor pulling the socket accounts each of them apart.
+
+    A forked child starts empty, what it records is sent with `flush` to the
+    queue of the MetricsCollector of the service.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self.stack = []
+        self.last_flush = time.time()
+
+    def check_fork(self):
+        if self.pid != os.getpid():
+            self.reset()
+
+    def count(self, name, n=1):
+        self.check_fork()
+        self.counters[name] += n
+
+    def observe(self, name, seconds):
+        self.check_fork()
+        self.histograms[name].observe(seconds)
+
+    def start(self):
+        self.check_fork()
+        self.stack.append(0.0)
+        return time.time()
+
+    def stop(self, start):
+        """ exclusive time of the stage started at `start` """
+        elapsed = time.time() - start
+        exclusive = elapsed - self.stack.pop()
+        if self.stack:
+            self.stack[-1] += elapsed
+        return exclusive
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = self.start()
+        try:
+            yield
+        finally:
+            self.observe(name, self.stop(start))
+
+    def timed(self, name, iterable):
+        """ items of `iterable`, the time spent producing all of them is one observation of `name` """
+        iterator, spent = iter(iterable), 0.0
+        try:
+            while True:
+                start = self.start()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    spent += self.stop(start)
+                yield item
+        finally:
+            self.observe(name, spent)
+
+    def snapshot(self):
+        self.check_fork()
+        return {'counters': dict(self.counters),
+                'histograms': dict((name, h.snapshot()) for name, h in self.histograms.items())}
+
+    def merge(self, snapshot):
+        self.counters.update(snapshot['counters'])
+        for name, histogram in snapshot['histograms'].items():
+            self.histograms[name].merge(histogram)
+
+    def flush(self, queue=None, interval=0):
+        """ sends what was recorded since the last flush, at most once per `interval` seconds """
+        queue = QUEUE if queue is None else queue
+        if queue is None or time.time() - self.last_flush < interval:
+            return
+
+        snapshot = self.snapshot()
+        if snapshot['counters'] or snapshot['histograms']:
+            queue.put(snapshot)
+        stack = self.stack
+        self.reset()
+        self.stack = stack
+
+
+class MetricsCollector:
+    """
+    merges the metrics flushed by every process of the service, and dumps the
+    totals to the log, and to a json file if given, every `interval` seconds.
+    """
+
+    def __init__(self, queue, log, interval, path=None):
+        self.queue = queue
+        self.log = log
+        self.interval = interval
+        self.path = path
+        self.totals = Metrics()
+        self.last_dump = time.time()
+
+    def poll(self):
+        while True:
+            try:
+                self.totals.merge(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        if self.interval and time.time() - self.last_dump >= self.interval:
+            self.dump()
+
+    def report(self):
+        return {'counters': dict(self.totals.counters),
+                'histograms': dict((name, h.summary()) for name, h in self.totals.histograms.items())}
+
+    def dump(self):
+        self.last_dump = time.time()
+        report = self.report()
+        self.log.info(' * counters: %s' % ', '.join('%s %s' % item for item in sorted(report['counters'].items())))
+        for name, summary in sorted(report['histograms'].items()):
+            self.log.info('   %s: %s in %.3f s, mean %.4f s, p50 %.4f s, p95 %.4f s, p99 %.4f s, max %.4f s' %
+                          (name, summary['count'], summary['total'], summary['mean'], summary['p50'],
+                           summary['p95'], summary['p99'], summary['max']))
+
+        if self.path:
+            with open(self.path, 'w') as metrics_file:
+                json.dump(report, metrics_file, indent=2, sort_keys=True)
+
+
+REGISTRY = Metrics()
+QUEUE = None
+COLLECTOR = None
+
+
+def enable(log, interval, path=None):
+    """ called by the service before any fork, every child flushes to the returned collector """
+    global QUEUE, COLLECTOR
+    QUEUE = multiprocessing.Queue()
+    COLLECTOR = MetricsCollector(QUEUE, log, interval, path)
+    return COLLECTOR
+
+
+def collect():
+    """ merges the pending metrics, in the process that enabled them """
+    if COLLECTOR is not None and COLLECTOR.totals.pid == os.getpid():
+        REGISTRY.flush()
+        COLLECTOR.poll()
+
+
+count = REGISTRY.count
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+timed = REGISTRY.timed
+flush = REGISTRY.flush
@@ -1,90 +1,257 @@
-import StringIO
 import argparse
+import itertools
+import logging
 import multiprocessing
 import socket
+import time
+import unittest
 
-import py7zlib
+import metrics
 
-from algebra import ArithmecticPool
-from common import get_log, descompress_7zip_stream, END_SEQUENCE
+from algebra import load_numpy, ArithmecticPool, OPERATORS, RESPONSE_COMPACT
+from common import get_log, peek, send_request, ChunkStream, ConnectionClosedException, LineStream, SocketReader
+from common import ConnectionLog, RequestTooLargeException, ResponseEncoder, ResponseWriter, SpilledResponse
+from common import RESPONSE_FORMAT_MASK
+from coordinator import CoordinatorService
+from eventloop import EventLoopService
+from input_codecs import find_codec, CorruptInputException
+from workers import ArithmeticWorkerPool, CacheManager, WorkerScheduler
 
 """
 python service.py --verbose --port 12345 --host 127.0.0.1
 """
 
 
+class ProcessorTest(unittest.TestCase):
+    @staticmethod
+    def serve(processor, client):
+        # the end of the client must be closed here too for the processor to see it closed
+        client.close()
+        processor.do_job()
+
+    def test_corrupt_upload_rejected(self):
+        server, client = socket.socketpair()
+        processor = Processor(server, 1024, logging.getLogger('test'), 1000)
+        send_request(client, '\x1f\x8b' + 'x' * 40, True)
+        client.shutdown(socket.SHUT_WR)
+        processor.do_job()
+        self.assertEqual('', client.recv(1024))
+        client.close()
+
+    def test_client_not_reading_does_not_stall_the_pool(self):
+        log = logging.getLogger('test')
+        pool = ArithmeticWorkerPool(log, min_workers=2, max_workers=2, jobs_per_worker=10 ** 6, no_slots=2,
+                                    batch_size=1000)
+        pool.start()
+        server, client = socket.socketpair()
+        processor = Processor(server, 1024, log, 1000, pool, scheduler=WorkerScheduler(inline_lines=1))
+        p = multiprocessing.Process(target=processor.do_job)
+        p.start()
+        server.close()
+
+        # the client never reads a response larger than the socket buffers, its batches do not fit in the pipe
+        # of its result channel either
+        send_request(client, '\n'.join(["1 + 1"] * 30000), True)
+        time.sleep(1)
+        other = multiprocessing.Process(target=pool.process, args=(["2 + 2"] * 200,))
+        other.start()
+        other.join(10)
+        try:
+            self.assertEqual(0, other.exitcode)
+        finally:
+            for process in (other, p):
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+            client.close()
+            pool.shutdown()
+
+    def test_requests_on_one_connection(self):
+        server, client = socket.socketpair()
+        # the first request is computed by the processor, the second one by children
+        processor = Processor(server, 1024, logging.getLogger('test'), 1000, calculator_options={'batch_size': 2},
+                              scheduler=WorkerScheduler(inline_lines=1))
+        p = multiprocessing.Process(target=self.serve, args=(processor, client))
+        p.start()
+        server.close()
+
+        send_request(client, "3 + 4", True)
+        send_request(client, "2 * 3\n1 + 1", True, RESPONSE_COMPACT)
+        reader = SocketReader(client, 1024)
+        self.assertTrue(''.join(reader.recv_chunks(True)).endswith('input_line[0]: 3 + 4 = 7.0 '))
+        self.assertEqual("0 6.0\n1 2.0", ''.join(reader.recv_chunks(True)))
+        client.close()
+        p.join()
+        self.assertEqual(0, p.exitcode)
+
+
 class Processor:
-    def __init__(self, client_socket, block_size, log, messages_per_child):
+    def __init__(self, client_socket, block_size, log, messages_per_child, pool=None, calculator_options=None,
+                 scheduler=None, spill_threshold=0, max_request_size=0, idle_timeout=0, ticket=None):
         self.messages_per_child = messages_per_child
+        self.spill_threshold = spill_threshold
+        self.idle_timeout = idle_timeout
+        self.calculator_options = calculator_options or {}
+        self.pool = pool
+        self.scheduler = scheduler or WorkerScheduler()
+        self.ticket = ticket
         self.socket = client_socket
+        self.reader = SocketReader(client_socket, block_size, max_request_size)
         self.data = None
+        self.upload = None
         self.log = log
         self.block_size = block_size
+        self.framed = False
+        self.flags = 0
+        self.expected_lines = None
+        self.started = None
 
     def get_data_from_socket(self):
+        """
+        the input format is found from the first bytes of the upload, its lines
+        are computed while the rest is still arriving and being decompressed.
+        7z archives need random access and are read whole.
+        """
         self.log.info('reading socket ...')
-        self.data = self.socket.recv(self.block_size)
-        no_chunks = 1
-        self.log.debug(' ... chunck read ... %s' % no_chunks)
-
-        while self.data[-len(END_SEQUENCE):] != END_SEQUENCE:
-            no_chunks += 1
-            self.data += self.socket.recv(self.block_size)
-            self.log.debug(' ... chunck read ... %s' % no_chunks)
-
-        self.data = self.data[:-len(END_SEQUENCE)]
-        self.log.info(' *** end of reading ***')
-        self.descompress_data()
-
-    def descompress_data(self):
-        self.log.info(' * descompressing data ...')
-        data_format = 'unknown'
-        try:
-            stream = StringIO.StringIO(self.data)
-            self.data = descompress_7zip_stream(stream)[0]
-            data_format = '7z'
-        except py7zlib.FormatError:
-            pass
-
-        if isinstance(self.data, str):
-            data_format = 'text'
-
-        self.data = self.data.strip('\n')
-        self.data = [i for i in self.data.split('\n') if i.strip()]
-        self.log.info(' * data format found: %s' % data_format)
+        self.expected_lines = None
+        flags, length, prefix = self.reader.recv_header()
+        self.started = time.time()
+        self.framed = flags is not None
+        self.flags = flags or 0
+        self.log.info(' * %s protocol' % ('framed' if self.framed else 'sentinel'))
+
+        head, chunks = peek(metrics.timed('receive', self.reader.iter_body(length, prefix)), self.block_size)
+        codec = find_codec(head)
+        if codec.name == 'text' and length and head:
+            self.expected_lines = length * head.count('\n') / len(head)
+
+        self.upload = ChunkStream(chunks)
+        self.data = metrics.timed('split', LineStream(metrics.timed('decompress', codec.decode(self.upload))))
+        self.log.info(' * data format found: %s, streaming lines' % codec.name)
+
+        if self.calculator_options.get('shared_memory'):
+            # the shared line table is built before the children start
+            self.data = list(self.data)
+            self.expected_lines = len(self.data)
+            self.log.info(' *** end of reading *** %s lines' % self.expected_lines)
+
+    def peek_lines(self, n):
+        """ the first n lines of the request, they stay at the start of the data """
+        if isinstance(self.data, list):
+            return self.data[:n]
+
+        head = list(itertools.islice(self.data, n))
+        self.data = itertools.chain(head, self.data)
+        return head
+
+    def upload_pending(self):
+        return self.upload is not None and not self.upload.exhausted
 
     def send_response(self):
         self.log.info(' * writting socket ...')
 
-        no_childs = min([(len(self.data) / self.messages_per_child),
-                         multiprocessing.cpu_count() * 3])
-        no_childs = no_childs if no_childs else 1
-        self.log.debug(' * number of calculated childs: %s' % no_childs)
-        calulator = ArithmecticPool(no_childs, self.log)
-        response = calulator.pool_processor(self.data)
-        data_to_send = "\n".join(response)
+        response_format = self.flags & RESPONSE_FORMAT_MASK
+        inline_lines = self.scheduler.inline_lines
+        no_childs, shared_pool = 0, False
+        if len(self.peek_lines(inline_lines + 1)) <= inline_lines:
+            self.log.debug(' * small request, computed by the processor')
+            metrics.count('inline requests')
+            calulator = ArithmecticPool(0, self.log, response_format=response_format, **self.calculator_options)
+            response = calulator.inline_results(self.data)
+        elif self.pool:
+            response = self.pool.results(self.data, response_format)
+            shared_pool = True
+        else:
+            no_childs = self.scheduler.acquire(self.expected_lines, self.messages_per_child, self.ticket)
+            self.log.debug(' * number of calculated childs: %s, scheduler ( requests, childs, lines ): %s' %
+                           (no_childs, self.scheduler.stats()))
+            calulator = ArithmecticPool(no_childs, self.log, response_format=response_format,
+                                        **self.calculator_options)
+            response = calulator.pool_results(self.data)
 
+        try:
+            self.write_response(response, blocking=not shared_pool)
+        finally:
+            if no_childs:
+                self.scheduler.release(no_childs, self.expected_lines, self.ticket)
+
+        shared_cache = self.calculator_options.get('shared_cache')
+        if shared_cache is not None:
+            self.log.info(' * shared cache: %s' % shared_cache.stats())
+
+    def write_response(self, response, blocking=True):
+        # ordered chunks are written as soon as they are ready, but not before the
+        # upload ends: a client still sending does not read and both sides would block.
+        # Meanwhile they are held, on disk past `spill_threshold` bytes.
+        # Without `blocking` only what the socket takes at once is written until the
+        # last chunk, the workers of a shared pool never wait for a slow client.
         self.log.info(' * sever responding ...')
-        self.socket.send(data_to_send + END_SEQUENCE)
+        writer, encoder = ResponseWriter(self.socket, self.framed), ResponseEncoder(self.flags)
+        held = SpilledResponse(self.spill_threshold)
+        no_lines = 0
+        for chunk in response:
+            no_lines += len(chunk)
+            with metrics.timer('encode'):
+                held.append(encoder.encode(chunk))
+            if not self.upload_pending():
+                with metrics.timer('send'):
+                    if blocking:
+                        held.drain(writer)
+                    else:
+                        held.send_ready(writer)
+
+        held.append(encoder.flush())
+        with metrics.timer('send'):
+            held.drain(writer)
+            writer.close()
+
+        if held.spilled:
+            self.log.info(' * %s bytes of the response spilled to disk' % held.spilled)
+            metrics.count('spilled bytes', held.spilled)
+
+        metrics.observe('request', time.time() - self.started)
+        metrics.count('requests')
+        metrics.count('lines', no_lines)
+        metrics.flush()
 
     def do_job(self):
         self.log.info(' * working ...')
-        self.get_data_from_socket()
-        self.send_response()
+        try:
+            while True:
+                self.get_data_from_socket()
+                self.send_response()
+                # framed clients may send more requests on the same connection
+                if not self.framed or self.reader.closed(self.idle_timeout):
+                    break
+        except ConnectionClosedException as ex:
+            self.log.info(' * connection lost: %s' % ex)
+        except (RequestTooLargeException, CorruptInputException) as ex:
+            self.log.warning(' * request rejected: %s' % ex)
         self.socket.close()
         self.log.info(' * end processor ...\n\n')
 
 
 class ArithmeticService:
-    def __init__(self, verbose, ip_address, port, no_sockets, block_size, messages_per_child):
+    MAINTENANCE_INTERVAL = 0.5
+
+    def __init__(self, verbose, ip_address, port, no_sockets, block_size, messages_per_child, pool=None,
+                 calculator_options=None, scheduler=None, spill_threshold=0, max_request_size=0, idle_timeout=0):
         self.verbose = verbose
+        self.spill_threshold = spill_threshold
+        self.max_request_size = max_request_size
+        self.idle_timeout = idle_timeout
         self.messages_per_child = messages_per_child
+        self.calculator_options = calculator_options
+        self.pool = pool
+        # shared by all the processors, created before any of them is forked
+        self.scheduler = scheduler or WorkerScheduler()
         self.log = get_log('Blueliv-Server', self.verbose)
         self.ip_address = ip_address
         self.port = port
         self.block_size = block_size
         self.no_sockets = no_sockets
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.processors = []
         self.log.info('  *** server running [ %s:%s ] ***' % (self.ip_address, self.port))
 
     def start_listenning(self):
@@ -92,18 +259,61 @@ class ArithmeticService:
         self.socket.listen(self.no_sockets)
 
     def launch_process_message(self, client_socket, address):
-        log = get_log('Blueliv-Server: conn [ %s:%s ]' % address, self.verbose)
-        arithmetic_processor = Processor(client_socket, self.block_size, log, self.messages_per_child)
+        ticket = self.scheduler.ticket()
+        arithmetic_processor = Processor(client_socket, self.block_size, ConnectionLog(self.log, address),
+                                         self.messages_per_child, self.pool, self.calculator_options, self.scheduler,
+                                         self.spill_threshold, self.max_request_size, self.idle_timeout, ticket)
         arithmetic_worker = multiprocessing.Process(target=arithmetic_processor.do_job)
         arithmetic_worker.start()
+        self.processors.append((arithmetic_worker, ticket))
+        # the processor owns the connection now, it ends when the processor closes it
+        client_socket.close()
 
     def run(self):
         self.start_listenning()
+
+        if self.pool:
+            self.pool.start()
+        # accept wakes up periodically so the processors are reaped, the pool kept in shape and the metrics collected
+        self.socket.settimeout(ArithmeticService.MAINTENANCE_INTERVAL)
+
         while 1:
-            (client_socket, address) = self.socket.accept()
+            try:
+                (client_socket, address) = self.socket.accept()
+            except socket.timeout:
+                self.maintain()
+                continue
+
+            client_socket.settimeout(None)
             self.log.info('connetion accepetd %s' % str(address))
+            metrics.count('connections')
             self.launch_process_message(client_socket, address)
+            self.maintain()
+
+        self.log.info(' *** server stopped ***')
 
+    def reap_processors(self):
+        """ joins the processors finished, the slots and children of the ones killed holding them are given back """
+        for processor, ticket in [(p, t) for p, t in self.processors if not p.is_alive()]:
+            processor.join()
+            self.processors.remove((processor, ticket))
+            if processor.exitcode:
+                self.scheduler.reclaim(ticket)
+                if self.pool:
+                    self.pool.reclaim_slots(processor.pid)
+
+    def maintain(self):
+        self.reap_processors()
+        if self.pool:
+            self.pool.maintain()
+        metrics.collect()
+
+    def stop(self):
+        if self.pool:
+            self.pool.shutdown()
+        if metrics.COLLECTOR:
+            metrics.collect()
+            metrics.COLLECTOR.dump()
         self.log.info(' *** server stopped ***')
 
 
@@ -115,9 +325,100 @@ def parse_defult_args(args):
         no_sockets = args.no_sockets or config.default_no_sockets
         block_size = args.block_size or config.default_socket_block_size
         messages_per_child = args.messages_per_child or config.default_messages_per_child
-        return host, port, no_sockets, block_size, messages_per_child
+        messages_per_batch = args.messages_per_batch or config.default_messages_per_batch
+        operator = args.operator or config.default_operator
+        return host, port, no_sockets, block_size, messages_per_child, messages_per_batch, operator
     except ImportError:
-        return args.host, args.port, args.no_sockets, args.block_size, args.messages_per_child
+        return (args.host, args.port, args.no_sockets, args.block_size, args.messages_per_child,
+                args.messages_per_batch, args.operator or 'fast')
+
+
+def parse_pool_args(args):
+    try:
+        import config
+        min_workers = args.pool_min_workers or config.default_pool_min_workers
+        max_workers = args.pool_max_workers or config.default_pool_max_workers
+        jobs_per_worker = args.jobs_per_worker or config.default_jobs_per_worker
+    except ImportError:
+        min_workers, max_workers, jobs_per_worker = args.pool_min_workers, args.pool_max_workers, args.jobs_per_worker
+
+    min_workers = min_workers or multiprocessing.cpu_count()
+    max_workers = max_workers or multiprocessing.cpu_count() * 3
+    return min_workers, max_workers, jobs_per_worker
+
+
+def parse_scheduler_args(args):
+    try:
+        import config
+        workers_per_cpu = args.workers_per_cpu or config.default_workers_per_cpu
+        inline_lines = config.default_inline_lines if args.inline_lines is None else args.inline_lines
+        return workers_per_cpu, inline_lines
+    except ImportError:
+        return args.workers_per_cpu or 1, 100 if args.inline_lines is None else args.inline_lines
+
+
+def parse_coordinator_args(args):
+    try:
+        import config
+        shard_lines = args.shard_lines or config.default_shard_lines
+        shard_retries = config.default_shard_retries if args.shard_retries is None else args.shard_retries
+        return shard_lines, shard_retries
+    except ImportError:
+        return args.shard_lines or 50000, 2 if args.shard_retries is None else args.shard_retries
+
+
+def parse_metrics_args(args):
+    try:
+        import config
+        metrics_interval = args.metrics_interval or config.default_metrics_interval
+        metrics_file = args.metrics_file or config.default_metrics_file
+        return metrics_interval, metrics_file
+    except ImportError:
+        return args.metrics_interval, args.metrics_file
+
+
+def parse_cache_args(args):
+    try:
+        import config
+        cache_size = args.cache_size or config.default_cache_size
+        shared_cache_size = args.shared_cache_size or config.default_shared_cache_size
+        return cache_size, shared_cache_size
+    except ImportError:
+        return args.cache_size, args.shared_cache_size
+
+
+def parse_supervision_args(args):
+    try:
+        import config
+        batch_timeout = config.default_batch_timeout if args.batch_timeout is None else args.batch_timeout
+        batch_retries = config.default_batch_retries if args.batch_retries is None else args.batch_retries
+        return batch_timeout, batch_retries
+    except ImportError:
+        return args.batch_timeout or 0, 1 if args.batch_retries is None else args.batch_retries
+
+
+def parse_spill_args(args):
+    try:
+        import config
+        return config.default_spill_threshold if args.spill_threshold is None else args.spill_threshold
+    except ImportError:
+        return args.spill_threshold or 0
+
+
+def parse_max_request_size(args):
+    try:
+        import config
+        return config.default_max_request_size if args.max_request_size is None else args.max_request_size
+    except ImportError:
+        return args.max_request_size or 0
+
+
+def parse_idle_timeout(args):
+    try:
+        import config
+        return config.default_idle_timeout if args.idle_timeout is None else args.idle_timeout
+    except ImportError:
+        return args.idle_timeout or 0
 
 
 def main():
@@ -146,17 +447,154 @@ def main():
                         type=int,
                         help="number of messages to be processed for a arimethic pool worker"
                         )
+    parser.add_argument("--messages_per_batch",
+                        type=int,
+                        help="number of messages sent to a worker at once, auto-tuned when not given"
+                        )
+    parser.add_argument("--operator",
+                        choices=sorted(OPERATORS),
+                        help="arithmetic operator implementation"
+                        )
+    parser.add_argument("--cache_size",
+                        type=int,
+                        help="results cached by each arithmetic worker, 0 disables the cache"
+                        )
+    parser.add_argument("--shared_cache_size",
+                        type=int,
+                        help="results cached for all the workers of the service, 0 disables the cache"
+                        )
+    parser.add_argument("--shared_memory",
+                        help="hand the decoded lines to the arithmetic workers in shared memory, only for the per "
+                             "request pools",
+                        action="store_true"
+                        )
+    parser.add_argument("--batch_timeout",
+                        type=float,
+                        help="seconds a child may spend on a batch before being replaced, 0 disables the timeout"
+                        )
+    parser.add_argument("--batch_retries",
+                        type=int,
+                        help="times the batch of a dead or timed out child is sent again before its lines fail"
+                        )
+    parser.add_argument("--max_request_size",
+                        type=int,
+                        help="bytes of the largest request accepted, the connection of a larger one is closed, "
+                             "0 accepts any size"
+                        )
+    parser.add_argument("--idle_timeout",
+                        type=float,
+                        help="seconds a kept alive connection may wait for its next request before being closed, "
+                             "0 waits forever"
+                        )
+    parser.add_argument("--spill_threshold",
+                        type=int,
+                        help="bytes of a response held in memory while the client uploads, the rest is spilled to a "
+                             "temporary file, 0 holds it all in memory"
+                        )
+    parser.add_argument("--persistent_pool",
+                        help="keep a pool of arithmetic workers alive across connections",
+                        action="store_true"
+                        )
+    parser.add_argument("--event_loop",
+                        help="serve every connection from a single poll loop, implies --persistent_pool",
+                        action="store_true"
+                        )
+    parser.add_argument("--pool_min_workers",
+                        type=int,
+                        help="minimum number of workers of the persistent pool"
+                        )
+    parser.add_argument("--pool_max_workers",
+                        type=int,
+                        help="maximum number of workers of the persistent pool"
+                        )
+    parser.add_argument("--jobs_per_worker",
+                        type=int,
+                        help="number of messages a persistent worker processes before being recycled"
+                        )
 
-    args = parser.parse_args()
-
-    host, port, no_sockets, block_size, messages_per_child = parse_defult_args(args)
+    parser.add_argument("--workers_per_cpu",
+                        type=float,
+                        help="children of the per request pools per cpu, shared by all the requests in flight"
+                        )
+    parser.add_argument("--inline_lines",
+                        type=int,
+                        help="requests of this many lines or less are computed without forking children"
+                        )
+    parser.add_argument("--backends",
+                        help="run as a coordinator sharding the requests among these services, host:port,host:port"
+                        )
+    parser.add_argument("--shard_lines",
+                        type=int,
+                        help="lines of the shards sent to each backend by a coordinator"
+                        )
+    parser.add_argument("--shard_retries",
+                        type=int,
+                        help="times a failed shard is sent again to another backend"
+                        )
+    parser.add_argument("--metrics_interval",
+                        type=float,
+                        help="seconds between dumps of the stage timings and counters of all the processes, "
+                             "0 disables them"
+                        )
+    parser.add_argument("--metrics_file",
+                        help="json file rewritten with the metrics on each dump"
+                        )
 
-    server = ArithmeticService(args.verbose, host, port, no_sockets, block_size, messages_per_child)
+    args = parser.parse_args()
+    if args.shared_memory and (args.persistent_pool or args.event_loop):
+        # the persistent pool workers are forked before any request, its lines can only go through the queues
+        parser.error('--shared_memory is not supported with --persistent_pool or --event_loop')
+
+    host, port, no_sockets, block_size, messages_per_child, messages_per_batch, operator = parse_defult_args(args)
+    max_request_size = parse_max_request_size(args)
+    if args.backends:
+        shard_lines, shard_retries = parse_coordinator_args(args)
+        server = CoordinatorService(args.verbose, host, port, no_sockets, block_size, args.backends.split(','),
+                                    shard_lines, shard_retries, max_request_size)
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            server.stop()
+        return
+
+    cache_size, shared_cache_size = parse_cache_args(args)
+    batch_timeout, batch_retries = parse_supervision_args(args)
+    calculator_options = dict(batch_size=messages_per_batch, operator=OPERATORS[operator], cache_size=cache_size,
+                              shared_memory=args.shared_memory, batch_timeout=batch_timeout,
+                              batch_retries=batch_retries)
+    if operator == 'vector':
+        # loaded once here instead of by every forked child
+        load_numpy()
+
+    metrics_interval, metrics_file = parse_metrics_args(args)
+    if metrics_interval:
+        # before any fork, every process of the service flushes its metrics to the collector
+        metrics.enable(get_log('Blueliv-Server: metrics', args.verbose), metrics_interval, metrics_file)
+
+    if shared_cache_size:
+        cache_manager = CacheManager()
+        cache_manager.start()
+        calculator_options['shared_cache'] = cache_manager.ResultCache(shared_cache_size)
+
+    pool = None
+    if args.persistent_pool or args.event_loop:
+        min_workers, max_workers, jobs_per_worker = parse_pool_args(args)
+        pool = ArithmeticWorkerPool(get_log('Blueliv-Server: pool', args.verbose),
+                                    min_workers, max_workers, jobs_per_worker, no_sockets, **calculator_options)
+
+    if args.event_loop:
+        server = EventLoopService(get_log('Blueliv-Server', args.verbose), host, port, no_sockets, block_size, pool,
+                                  max_request_size)
+    else:
+        workers_per_cpu, inline_lines = parse_scheduler_args(args)
+        server = ArithmeticService(args.verbose, host, port, no_sockets, block_size, messages_per_child, pool,
+                                   calculator_options, WorkerScheduler(workers_per_cpu, inline_lines),
+                                   parse_spill_args(args), max_request_size, parse_idle_timeout(args))
 
     try:
         server.run()
     except KeyboardInterrupt:
-        log.info(' *** server stopped ***')
+        server.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,621 @@
+import Queue
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import unittest
+
+from multiprocessing.managers import BaseManager
+
+import metrics
+from algebra import ArithmecticPool, KillingOperator, ResultCache, WorkerFailedException, RESPONSE_COMPACT
+from algebra import RESPONSE_VERBOSE
+
+
+class ArithmeticWorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ArithmeticWorkerPool(logging.getLogger('test'), min_workers=2, max_workers=3, jobs_per_worker=2,
+                                         no_slots=2, scale_up_depth=10, batch_size=1)
+        self.pool.start()
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_process(self):
+        response = self.pool.process(["3 + 4", "2 * 3"])
+        self.assertEqual(2, len(response))
+        self.assertTrue(response[0].endswith('input_line[0]: 3 + 4 = 7.0 '))
+        self.assertTrue(response[1].endswith('input_line[1]: 2 * 3 = 6.0 '))
+
+    def test_workers_are_recycled(self):
+        self.pool.process(["1 + 1"] * 4)
+        # recycled workers leave by themselves, the parent reaps and replaces them
+        deadline = time.time() + 5
+        while self.pool.recycled < 2 and time.time() < deadline:
+            time.sleep(0.05)
+            self.pool.maintain()
+        self.assertEqual(2, self.pool.recycled)
+        self.assertEqual(2, len(self.pool.workers))
+
+    def test_slots_of_dead_processors_reclaimed(self):
+        def hold_slot():
+            results = self.pool.results(["1 + 1"])
+            next(results)
+            os.kill(os.getpid(), signal.SIGKILL)
+
+        p = multiprocessing.Process(target=hold_slot)
+        p.start()
+        p.join()
+        self.pool.reclaim_slots(p.pid)
+        self.assertEqual([0, 1], sorted(self.pool.free_slots.get(timeout=1) for _ in range(2)))
+
+    def test_pool_grows_with_queue_depth(self):
+        for n in range(self.pool.scale_up_depth * 3):
+            self.pool.task_queue.put((None, None, n, ["1 + 1"], RESPONSE_VERBOSE))
+        self.pool.maintain()
+        self.assertEqual(3, len(self.pool.workers))
+
+
+class ArithmeticWorkerPoolSupervisionTest(unittest.TestCase):
+    OPERATIONS = ["%s + 1" % n for n in range(10)] + ["kill"] + ["%s * 2" % n for n in range(10)]
+
+    def process(self, operations, kills=0, **options):
+        """ computes the request in a processor while the parent maintains the pool """
+        KillingOperator.kills = multiprocessing.Value('i', kills)
+        pool = ArithmeticWorkerPool(logging.getLogger('test'), min_workers=2, max_workers=2, jobs_per_worker=1000,
+                                    no_slots=1, batch_size=2, operator=KillingOperator, **options)
+        pool.start()
+        results = multiprocessing.Queue()
+        p = multiprocessing.Process(target=lambda: results.put(pool.process(operations)))
+        p.start()
+        try:
+            deadline = time.time() + 10
+            while results.empty() and time.time() < deadline:
+                pool.maintain()
+                time.sleep(0.05)
+            return [r.split(' response, ')[1] for r in results.get(timeout=1)]
+        finally:
+            p.join(1)
+            pool.shutdown()
+
+    def test_batch_of_a_dead_worker_sent_again(self):
+        expected = [r.split(' response, ')[1] for r in ArithmecticPool(1, logging.getLogger('test'))
+                    .evaluate_batch(0, 0, ArithmeticWorkerPoolSupervisionTest.OPERATIONS)]
+        self.assertEqual(expected, self.process(ArithmeticWorkerPoolSupervisionTest.OPERATIONS, 1, batch_retries=1))
+        self.assertEqual(0, KillingOperator.kills.value)
+
+    def test_per_line_errors_after_the_retries(self):
+        response = self.process(ArithmeticWorkerPoolSupervisionTest.OPERATIONS, 1, batch_retries=0)
+        self.assertEqual(21, len(response))
+        self.assertEqual('input_line[10]: kill = worker died ', response[10])
+        self.assertEqual('input_line[11]: 0 * 2 = worker died ', response[11])
+        self.assertEqual('input_line[12]: 1 * 2 = 2.0 ', response[12])
+
+    def test_batch_timeout(self):
+        response = self.process(["3 + 4", "2 * 3", "hang"], batch_timeout=0.5, batch_retries=0)
+        self.assertEqual(['input_line[0]: 3 + 4 = 7.0 ', 'input_line[1]: 2 * 3 = 6.0 ',
+                          'input_line[2]: hang = timed out after 0.5 s '], response)
+
+
+class PoolRequestTest(unittest.TestCase):
+    def test_reorder_window_bounds_the_results_held(self):
+        pool = ArithmeticWorkerPool(logging.getLogger('test'), min_workers=1, max_workers=1, jobs_per_worker=10,
+                                    no_slots=1, batch_size=1)
+        pool.reorder_window, pool.task_queue = 2, Queue.Queue()
+        request = PoolRequest(pool, 0, ["%s + 1" % n for n in range(10)])
+        request.dispatch()
+        self.assertEqual([], request.receive((request.request_id, 1, ["1"])))
+        # batch 0 is late, nothing else is queued while batch 1 waits for it
+        self.assertEqual(2, pool.task_queue.qsize())
+        self.assertEqual([["0"], ["1"]], request.receive((request.request_id, 0, ["0"])))
+        self.assertEqual(4, pool.task_queue.qsize())
+
+    def test_failed_batch(self):
+        pool = ArithmeticWorkerPool(logging.getLogger('test'), min_workers=1, max_workers=1, jobs_per_worker=10,
+                                    no_slots=1, batch_size=2, batch_retries=1)
+        pool.task_queue = Queue.Queue()
+        request = PoolRequest(pool, 0, ["1 + 1", "2 + 2"], RESPONSE_COMPACT)
+        request.dispatch()
+        pool.task_queue.get()
+        self.assertEqual([], request.receive((request.request_id, 0, BatchFailure(3, 'worker died'))))
+        self.assertEqual((0, request.request_id, 0, ["1 + 1", "2 + 2"], RESPONSE_COMPACT), pool.task_queue.get())
+        self.assertEqual([["0 worker died", "1 worker died"]],
+                         request.receive((request.request_id, 0, BatchFailure(4, 'worker died'))))
+        # the answer of a batch already failed is dropped
+        self.assertEqual([], request.receive((request.request_id, 0, ["0 2.0", "1 4.0"])))
+        self.assertTrue(request.finished())
+
+
+class SharedResultCacheTest(unittest.TestCase):
+    def test_shared_between_processes(self):
+        manager = CacheManager()
+        manager.start()
+        try:
+            cache = manager.ResultCache(10)
+            p = multiprocessing.Process(target=cache.put_many, args=([('3 + 4', 7.0)],))
+            p.start()
+            p.join()
+            self.assertEqual([7.0, None], cache.get_many(['3 + 4', '1 + 1']))
+        finally:
+            manager.shutdown()
+
+
+class WorkerSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = WorkerScheduler(workers_per_cpu=2, no_cpus=2)
+        self.scheduler.load_average = lambda: (0.0, 0.0, 0.0)
+
+    def test_children_needed_by_the_lines(self):
+        self.assertEqual(2, self.scheduler.acquire(1500, 1000))
+        self.assertEqual(1, self.scheduler.acquire(10, 1000))
+
+    def test_fair_share_of_the_requests_in_flight(self):
+        self.assertEqual(4, self.scheduler.acquire(None, 1000))
+        # a busy service still gives one child to every request
+        self.assertEqual(1, self.scheduler.acquire(30000, 1000))
+        self.scheduler.release(4, None)
+        self.assertEqual(2, self.scheduler.acquire(10000, 1000))
+        self.assertEqual((2, 3, 40000), self.scheduler.stats())
+
+    def test_share_weighted_by_the_lines(self):
+        self.assertEqual(1, self.scheduler.acquire(1000, 1000))
+        # an equal share would be 2 children, the request has 9 of the 10 thousand lines queued
+        self.assertEqual(3, self.scheduler.acquire(9000, 1000))
+
+    def test_ticket_of_a_dead_processor_reclaimed(self):
+        ticket = self.scheduler.ticket()
+        self.assertEqual(4, self.scheduler.acquire(5000, 1000, ticket))
+        self.assertEqual((1, 4, 5000), self.scheduler.stats())
+        self.scheduler.reclaim(ticket)
+        self.scheduler.reclaim(ticket)
+        self.assertEqual((0, 0, 0), self.scheduler.stats())
+
+        self.scheduler.release(self.scheduler.acquire(5000, 1000, ticket), 5000, ticket)
+        self.scheduler.reclaim(ticket)
+        self.assertEqual((0, 0, 0), self.scheduler.stats())
+
+    def test_external_load(self):
+        self.scheduler.load_average = lambda: (3.0, 0.0, 0.0)
+        self.assertEqual(1, self.scheduler.acquire(None, 1000))
+
+
+class CacheManager(BaseManager):
+    """ serves a ResultCache shared by every worker of the service """
+    pass
+
+
+CacheManager.register('ResultCache', ResultCache)
+
+
+class WorkerScheduler:
+    """
+    shares the cpus among the requests computed by per request pools in every
+    processor of the service. It is created before the processors are forked,
+    the requests in flight, the lines they have queued and the children given
+    to them are kept in shared memory.
+
+    A request gets the children its lines need, at most a share of the budget
+    ( `workers_per_cpu` per cpu ) as large as its part of the lines queued, or
+    an equal share among the requests in flight when that is larger, and never
+    more than the cpus left free by the other requests and by the rest of the
+    machine according to the load average. Every request gets at least one child.
+
+    Requests of `inline_lines` lines or less are computed in the processor.
+
+    A processor records what it holds in a ticket created by the parent, the
+    parent gives back the children and lines of a processor that dies holding them.
+    """
+
+    def __init__(self, workers_per_cpu=1, inline_lines=100, no_cpus=None):
+        self.no_cpus = no_cpus or multiprocessing.cpu_count()
+        self.budget = max(1, int(self.no_cpus * workers_per_cpu))
+        self.inline_lines = inline_lines
+        self.load_average = os.getloadavg
+        self.lock = multiprocessing.Lock()
+        self.active_requests = multiprocessing.Value('i', 0, lock=False)
+        self.allotted = multiprocessing.Value('i', 0, lock=False)
+        self.queued_lines = multiprocessing.Value('l', 0, lock=False)
+
+    def external_load(self):
+        """ runnable processes other than the children of the service, from the last minute load average """
+        return max(0, int(round(self.load_average()[0])) - self.allotted.value)
+
+    @staticmethod
+    def ticket():
+        """ children and lines held by the request of one processor """
+        return multiprocessing.RawArray('l', 2)
+
+    def acquire(self, expected_lines, messages_per_child, ticket=None):
+        with self.lock:
+            self.active_requests.value += 1
+            self.queued_lines.value += expected_lines or 0
+
+            wanted = -(-expected_lines // messages_per_child) if expected_lines else self.budget
+            share = self.budget // self.active_requests.value
+            if expected_lines:
+                share = max(share, self.budget * expected_lines // self.queued_lines.value)
+            free = self.budget - self.allotted.value - self.external_load()
+
+            no_childs = max(1, min(wanted, share, free))
+            self.allotted.value += no_childs
+            if ticket is not None:
+                ticket[0], ticket[1] = no_childs, expected_lines or 0
+            return no_childs
+
+    def release(self, no_childs, expected_lines, ticket=None):
+        with self.lock:
+            self.active_requests.value -= 1
+            self.queued_lines.value -= expected_lines or 0
+            self.allotted.value -= no_childs
+            if ticket is not None:
+                ticket[0] = ticket[1] = 0
+
+    def reclaim(self, ticket):
+        """ releases the request of a processor that died before releasing it """
+        if ticket[0]:
+            self.release(ticket[0], ticket[1], ticket)
+
+    def stats(self):
+        """ requests in flight, children given to them and lines they have queued """
+        return self.active_requests.value, self.allotted.value, self.queued_lines.value
+
+
+class ResultChannel:
+    """
+    pipe with several writers ( the pool workers ) and a single reader ( the
+    processor owning the slot ), writes are serialized with a lock.
+    """
+
+    def __init__(self):
+        self.reader, self.writer = multiprocessing.Pipe(duplex=False)
+        self.lock = multiprocessing.Lock()
+
+    def send(self, msg, timeout=None):
+        """ False when the lock is not taken in `timeout` seconds, a writer died holding it """
+        if not self.lock.acquire(True, timeout):
+            return False
+        try:
+            self.writer.send(msg)
+        finally:
+            self.lock.release()
+        return True
+
+    def recv(self):
+        return self.reader.recv()
+
+
+class BatchFailure:
+    """ sent to a slot by the parent instead of the results of a batch whose worker died or timed out """
+
+    def __init__(self, worker, reason):
+        self.worker = worker
+        self.reason = reason
+
+
+class PoolRequest:
+    """
+    one request computed by an ArithmeticWorkerPool through a result slot. At
+    most `reorder_window` batches are queued ahead of the oldest one pending,
+    results are handed out in input order.
+
+    The batches in flight are kept until answered: a failed one is queued again
+    up to `batch_retries` times, then its lines get a WorkerFailedException.
+    """
+    ids = itertools.count()
+
+    def __init__(self, pool, slot, operations_data, response_format=RESPONSE_VERBOSE):
+        self.pool = pool
+        self.slot = slot
+        self.response_format = response_format
+        self.request_id = (os.getpid(), next(PoolRequest.ids))
+        self.batches = pool.calculator.batches(operations_data)
+        self.done = {}
+        self.in_flight = self.next_line = 0
+        # batches queued and handed out, the ones in between are in flight or waiting in `done`
+        self.dispatched = self.yielded = 0
+        self.exhausted = False
+        # batches in flight by their first line, with the times they were sent again
+        self.sent = {}
+
+    def dispatch(self):
+        with metrics.timer('dispatch'):
+            while not self.exhausted and self.dispatched - self.yielded < self.pool.reorder_window:
+                try:
+                    batch, n = next(self.batches)
+                except StopIteration:
+                    self.exhausted = True
+                    break
+                self.sent[n] = (batch, 0)
+                self.pool.task_queue.put((self.slot, self.request_id, n, batch, self.response_format))
+                self.in_flight += 1
+                self.dispatched += 1
+
+    def abandon(self):
+        """ nothing else is queued, the batches in flight are still drained """
+        self.exhausted = True
+
+    def finished(self):
+        return self.exhausted and not self.in_flight
+
+    def receive(self, response):
+        """ chunks of results ready to be sent after a response of the slot """
+        (response_id, n, elements) = response
+        # leftovers of a previous owner of the slot, and answers of batches already failed, are dropped
+        if response_id != self.request_id or n not in self.sent:
+            return []
+
+        if isinstance(elements, BatchFailure):
+            elements = self.failed(n, elements)
+            if elements is None:
+                return []
+
+        del self.sent[n]
+        self.done[n] = elements
+        self.in_flight -= 1
+
+        chunks = []
+        while self.next_line in self.done:
+            chunk = self.done.pop(self.next_line)
+            self.next_line += len(chunk)
+            self.yielded += 1
+            chunks.append(chunk)
+
+        self.dispatch()
+        return chunks
+
+    def failed(self, n, failure):
+        """ the batch is queued again and None returned, or its results are the error once out of retries """
+        (batch, retries) = self.sent[n]
+        calculator = self.pool.calculator
+        metrics.count('worker failures')
+        if retries < calculator.batch_retries:
+            self.pool.log.warning('batch from input_line[%s] sent again, worker %s: %s' %
+                                  (n, failure.worker, failure.reason))
+            self.sent[n] = (batch, retries + 1)
+            self.pool.task_queue.put((self.slot, self.request_id, n, batch, self.response_format))
+            return None
+
+        self.pool.log.error('batch from input_line[%s] failed, worker %s: %s' % (n, failure.worker, failure.reason))
+        return calculator.format_results(failure.worker, n, batch, [WorkerFailedException(failure.reason)] * len(batch),
+                                         self.response_format)
+
+
+class ArithmeticWorkerPool:
+    """
+    Long-lived pool of arithmetic workers shared by all the connections of the
+    service. It must be started before the processors are forked so they inherit
+    the task queue and the result channels.
+
+    Each processor borrows one of the `no_slots` result channels while its request
+    is being computed, lines travel in batches as in ArithmecticPool. A worker stops
+    taking batches after `jobs_per_worker` lines, the parent, calling `maintain`,
+    sends it the stop message on its control pipe, joins it and creates the
+    replacement. It also reclaims the slots of the processors that died holding one.
+
+    Each worker records the batch it is computing. When it dies, or spends more
+    than `batch_timeout` seconds on the batch and is terminated, the parent sends
+    a BatchFailure to the slot of the batch and the request decides what to do.
+
+    The pool grows by one worker for every `scale_up_depth` batches waiting in the
+    task queue. Each request queues at most `reorder_window` batches, so the depth
+    is counted in batches and not in lines.
+
+    `calculator_options` are the ArithmecticPool options ( batch_size, operator,
+    cache_size, ... ) used by the workers, each of them owns its result cache.
+    """
+    CACHE_LOG_INTERVAL = 1000
+    METRICS_FLUSH_INTERVAL = 1
+    # seconds the parent waits for the lock of a result channel, a worker may have died holding it
+    FAILURE_SEND_TIMEOUT = 1
+    IDLE = -1
+
+    def __init__(self, log, min_workers, max_workers, jobs_per_worker, no_slots, scale_up_depth=4,
+                 **calculator_options):
+        self.log = log
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.jobs_per_worker = jobs_per_worker
+        self.scale_up_depth = scale_up_depth
+        self.reorder_window = self.max_workers * 4
+        self.calculator = ArithmecticPool(0, log, **calculator_options)
+
+        self.task_queue = multiprocessing.Queue()
+        self.free_slots = multiprocessing.Queue()
+        self.result_channels = [ResultChannel() for _ in range(no_slots)]
+        # pid of the processor owning each slot, 0 for the free ones
+        self.slot_owners = multiprocessing.RawArray('l', no_slots)
+        for slot in range(no_slots):
+            self.free_slots.put(slot)
+
+        self.workers = {}
+        # lines done by each worker and the pipe of its stop message
+        self.controls = {}
+        # batch computed by each worker: slot ( IDLE when none ), request id, first line and start time
+        self.batches = {}
+        # called with the slot and the failure instead of sending it, by a parent reading the channels itself
+        self.failure_handler = None
+        self.next_worker_id = 0
+        self.retiring = 0
+        self.recycled = 0
+
+    def log_cache_stats(self, i):
+        if self.calculator.cache:
+            self.log.info('worker %s cache: %s' % (i, self.calculator.cache.stats()))
+
+    def worker_loop(self, i, jobs_done, control, current):
+        batches_done = 0
+        while jobs_done.value < self.jobs_per_worker:
+            (slot, request_id, n, batch, response_format) = self.task_queue.get()
+
+            if batch == ArithmecticPool.STOP_PILL:
+                metrics.flush()
+                self.log_cache_stats(i)
+                self.log.debug("worker %s retired" % i)
+                return
+
+            if slot is not None:
+                current[1:] = [request_id[0], request_id[1], n, time.time()]
+                current[0] = slot
+                with metrics.timer('compute'):
+                    results = self.calculator.evaluate_batch(i, n, batch, response_format)
+                metrics.count('lines computed', len(batch))
+                self.result_channels[slot].send((request_id, n, results))
+                current[0] = ArithmeticWorkerPool.IDLE
+            jobs_done.value += len(batch)
+            batches_done += 1
+            # an idle worker may be terminated before the next interval
+            metrics.flush(interval=0 if self.task_queue.empty() else ArithmeticWorkerPool.METRICS_FLUSH_INTERVAL)
+            if not batches_done % ArithmeticWorkerPool.CACHE_LOG_INTERVAL:
+                self.log_cache_stats(i)
+
+        metrics.flush()
+        self.log_cache_stats(i)
+        # the parent destroys the worker once it sees its lines done
+        control.recv()
+        self.log.debug("worker %s recycled" % i)
+
+    def spawn_worker(self):
+        i = self.next_worker_id
+        self.next_worker_id += 1
+        jobs_done = multiprocessing.RawValue('l', 0)
+        control, stop = multiprocessing.Pipe(duplex=False)
+        current = multiprocessing.RawArray('d', [ArithmeticWorkerPool.IDLE, 0, 0, 0, 0])
+        p = multiprocessing.Process(target=self.worker_loop, args=(i, jobs_done, control, current))
+        p.daemon = True
+        p.start()
+        control.close()
+        self.workers[i] = p
+        self.controls[i] = (jobs_done, stop)
+        self.batches[i] = current
+        self.log.debug(' -> worker %s created, workers running: %s' % (i, len(self.workers)))
+
+    def retire_worker(self):
+        self.retiring += 1
+        self.task_queue.put((None, None, 0, ArithmecticPool.STOP_PILL, None))
+
+    def recycle(self):
+        """ stops the workers that have done their lines """
+        for i, (jobs_done, stop) in list(self.controls.items()):
+            if jobs_done.value < self.jobs_per_worker or not self.workers[i].is_alive():
+                continue
+
+            stop.send(ArithmecticPool.STOP_PILL)
+            self.workers.pop(i).join()
+            self.controls.pop(i)[1].close()
+            del self.batches[i]
+            self.recycled += 1
+            self.log.debug(' -> worker %s recycled' % i)
+
+    def reap(self):
+        for i, p in list(self.workers.items()):
+            if p.is_alive():
+                continue
+
+            p.join()
+            del self.workers[i]
+            self.controls.pop(i)[1].close()
+            if p.exitcode == 0:
+                self.retiring -= 1
+            else:
+                self.log.critical(' -> worker %s died with exit code %s' % (i, p.exitcode))
+                self.fail_batch(i, 'worker died')
+            del self.batches[i]
+            self.log.debug(' -> worker %s destroyed' % i)
+
+    def stop_slow_workers(self):
+        """ terminates the workers busy with a batch for more than `batch_timeout` seconds """
+        timeout = self.calculator.batch_timeout
+        if not timeout:
+            return
+
+        now = time.time()
+        for i, current in self.batches.items():
+            if current[0] != ArithmeticWorkerPool.IDLE and now - current[4] > timeout and self.workers[i].is_alive():
+                self.workers[i].terminate()
+                self.workers[i].join()
+                self.fail_batch(i, 'timed out after %s s' % timeout)
+
+    def fail_batch(self, i, reason):
+        """ tells the request of the batch of a worker gone that it will not be answered """
+        current = self.batches[i]
+        slot = int(current[0])
+        if slot == ArithmeticWorkerPool.IDLE:
+            return
+
+        current[0] = ArithmeticWorkerPool.IDLE
+        request_id, n = (int(current[1]), int(current[2])), int(current[3])
+        self.log.warning(' -> batch from input_line[%s] of slot %s not answered by worker %s: %s' %
+                         (n, slot, i, reason))
+        failure = (request_id, n, BatchFailure(i, reason))
+        if self.failure_handler:
+            self.failure_handler(slot, failure)
+        elif not self.result_channels[slot].send(failure, ArithmeticWorkerPool.FAILURE_SEND_TIMEOUT):
+            self.log.critical(' -> result channel of slot %s locked by a dead worker' % slot)
+
+    def maintain(self):
+        """
+        reaps the finished workers and resizes the pool between its bounds
+        according to the number of batches waiting in the task queue.
+        """
+        self.recycle()
+        self.stop_slow_workers()
+        self.reap()
+        running = len(self.workers) - self.retiring
+        depth = self.task_queue.qsize()
+
+        wanted = max(self.min_workers, min(self.max_workers, depth / self.scale_up_depth + 1))
+        if wanted > running:
+            for _ in range(wanted - running):
+                self.spawn_worker()
+        elif depth == 0 and running > self.min_workers:
+            self.retire_worker()
+
+    def start(self):
+        for _ in range(self.min_workers):
+            self.spawn_worker()
+        self.log.info(' * worker pool started: %s workers' % self.min_workers)
+
+    def shutdown(self):
+        for p in self.workers.values():
+            p.terminate()
+            p.join()
+        for _, stop in self.controls.values():
+            stop.close()
+        self.workers, self.controls, self.batches = {}, {}, {}
+        self.log.info(' * worker pool stopped')
+
+    def results(self, operations_data, response_format=RESPONSE_VERBOSE):
+        """ generator of chunks of results in input order """
+        slot = self.free_slots.get()
+        self.slot_owners[slot] = os.getpid()
+        request = PoolRequest(self, slot, operations_data, response_format)
+
+        try:
+            request.dispatch()
+            while not request.finished():
+                with metrics.timer('collect'):
+                    response = self.result_channels[slot].recv()
+                for chunk in request.receive(response):
+                    yield chunk
+        finally:
+            self.slot_owners[slot] = 0
+            self.free_slots.put(slot)
+
+    def reclaim_slots(self, pid):
+        """ frees the slots of a processor gone without returning them """
+        for slot, owner in enumerate(self.slot_owners):
+            if owner == pid:
+                self.log.warning(' -> slot %s of the dead processor %s reclaimed' % (slot, pid))
+                self.slot_owners[slot] = 0
+                self.free_slots.put(slot)
+
+    def process(self, operations_data):
+        results = []
+        for chunk in self.results(operations_data):
+            results.extend(chunk)
+
+        self.log.info(' * work done: operations returned %s' % len(results))
+
+        return results